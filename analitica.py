@@ -0,0 +1,184 @@
+# analitica.py — analítica de ventas en columnas (NumPy)
+#
+# Las ventas y renglones de un rango se traen con COPY ... (FORMAT binary):
+# todas las columnas son de ancho fijo y sin NULL, así que el flujo se lee
+# directo como arreglo estructurado, sin armar filas en Python. Todo lo demás
+# (top de productos, mapa hora × día, canasta, redondeo, pares) son pasadas
+# vectorizadas sobre esos arreglos.
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from db import get_db
+
+# Canastas con más productos distintos no cuentan para pares (evita n² en ventas enormes)
+MAX_CANASTA_PARES = 40
+
+# Encabezado (19 bytes) y cola (2 bytes) del formato binario de COPY
+_COPY_ENCABEZADO = 19
+_COPY_COLA = 2
+
+def _dtype_copy(campos) -> np.dtype:
+    """Fila de COPY binario: int16 (nº de campos) y por campo int32 (largo) + valor."""
+    cols = [("_n", ">i2")]
+    for nombre, tipo in campos:
+        cols += [(f"_l_{nombre}", ">i4"), (nombre, tipo)]
+    return np.dtype(cols)
+
+DTYPE_VENTAS = _dtype_copy([
+    ("venta", ">i8"), ("hora", ">i2"), ("dia", ">i2"), ("total", ">i8"), ("redondeo", ">i8"),
+])
+DTYPE_ITEMS = _dtype_copy([
+    ("venta", ">i8"), ("producto", ">i4"), ("cantidad", ">i4"), ("importe", ">i8"),
+])
+
+# Productos numerados 1..N por id; los renglones llevan el número, no el texto
+_PRODUCTOS_SQL = "SELECT id, nombre FROM productos ORDER BY id"
+# El folio solo agrupa renglones por venta: los de texto (antes de
+# migrar-folios) se pasan a un entero con hash
+_ID_NUMERICO = "{col}::int8"
+_ID_TEXTO = "hashtextextended({col}, 0)"
+_VENTAS_SQL = """
+    SELECT {venta},
+           extract(hour FROM v.momento AT TIME ZONE %(tz)s)::int2,
+           (extract(isodow FROM v.momento AT TIME ZONE %(tz)s) - 1)::int2,
+           round(v.total * 100)::int8,
+           round(COALESCE(v.redondeo, 0) * 100)::int8
+    FROM ventas v
+    WHERE v.momento >= %(desde)s AND v.momento < %(hasta)s
+"""
+_ITEMS_SQL = """
+    SELECT {venta}, p.k::int4, vi.cantidad::int4,
+           round(vi.cantidad * vi.precio_unitario * 100)::int8
+    FROM venta_items vi
+    JOIN (SELECT id, row_number() OVER (ORDER BY id) AS k FROM productos) p ON p.id = vi.producto_id
+    WHERE vi.venta_momento >= %(desde)s AND vi.venta_momento < %(hasta)s
+"""
+
+def _copiar(cur, sql: str, params: Dict, dtype: np.dtype) -> np.ndarray:
+    buf = bytearray()
+    with cur.copy(f"COPY ({sql}) TO STDOUT (FORMAT binary)", params) as copy:
+        for bloque in copy:
+            buf += bloque
+    n = (len(buf) - _COPY_ENCABEZADO - _COPY_COLA) // dtype.itemsize
+    if n <= 0:
+        return np.zeros(0, dtype=dtype)
+    return np.frombuffer(buf, dtype=dtype, count=n, offset=_COPY_ENCABEZADO)
+
+def cargar(desde: datetime, hasta: datetime, tz: str, folios_texto: bool = False):
+    """(ventas, items, productos) del rango [desde, hasta); productos[k-1] = (id, nombre)."""
+    id_sql = _ID_TEXTO if folios_texto else _ID_NUMERICO
+    with get_db(solo_lectura=True) as conn:
+        # Una sola foto para la numeración de productos y los renglones
+        conn.execute("COMMIT")
+        conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        productos = [(r["id"], r["nombre"]) for r in conn.execute(_PRODUCTOS_SQL).fetchall()]
+        params = {"tz": tz, "desde": desde, "hasta": hasta}
+        with conn.cursor() as cur:
+            ventas = _copiar(cur, _VENTAS_SQL.format(venta=id_sql.format(col="v.id")), params, DTYPE_VENTAS)
+            items = _copiar(cur, _ITEMS_SQL.format(venta=id_sql.format(col="vi.venta_id")), params, DTYPE_ITEMS)
+    return ventas, items, productos
+
+def _pares(venta: np.ndarray, producto: np.ndarray, top: int):
+    """Pares de productos comprados juntos: (a, b, veces) con a < b, del más frecuente."""
+    if venta.size == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64)
+    # Un renglón por (venta, producto), ordenado por venta y luego producto
+    orden = np.lexsort((producto, venta))
+    v, p = venta[orden].astype(np.int64), producto[orden].astype(np.int64)
+    distinto = np.r_[True, (v[1:] != v[:-1]) | (p[1:] != p[:-1])]
+    v, p = v[distinto], p[distinto]
+
+    inicio = np.r_[0, np.flatnonzero(np.diff(v)) + 1]
+    tam = np.diff(np.r_[inicio, v.size])
+    chica = np.repeat(tam <= MAX_CANASTA_PARES, tam)
+    v, p = v[chica], p[chica]
+
+    # Desplazamiento d: emparejar cada renglón con el que está d lugares adelante en su venta
+    codigos = []
+    for d in range(1, min(MAX_CANASTA_PARES, v.size)):
+        misma = v[d:] == v[:-d]
+        if not misma.any():
+            break
+        codigos.append(p[:-d][misma] << 32 | p[d:][misma])
+    if not codigos:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64)
+    unicos, veces = np.unique(np.concatenate(codigos), return_counts=True)
+    orden = np.argsort(veces, kind="stable")[::-1][:top]
+    return unicos[orden] >> 32, unicos[orden] & 0xFFFFFFFF, veces[orden]
+
+def calcular(ventas: np.ndarray, items: np.ndarray, productos: List, top: int = 20) -> Dict:
+    """Indicadores del rango a partir de los arreglos de cargar()."""
+    n_ventas = int(ventas.size)
+    nombre = lambda k: productos[k - 1][1] if 0 < k <= len(productos) else str(k)
+    codigo = lambda k: productos[k - 1][0] if 0 < k <= len(productos) else str(k)
+
+    # Top de productos por unidades e importe
+    n_prod = len(productos) + 1
+    unidades = np.bincount(items["producto"], weights=items["cantidad"], minlength=n_prod)
+    importe = np.bincount(items["producto"], weights=items["importe"], minlength=n_prod)
+    top_k = np.argsort(unidades, kind="stable")[::-1][:top]
+    top_k = top_k[unidades[top_k] > 0]
+
+    # Mapa de calor: lunes..domingo × 0..23 h
+    celda = ventas["dia"].astype(np.int64) * 24 + ventas["hora"]
+    mapa_ventas = np.bincount(celda, minlength=7 * 24).reshape(7, 24)
+    mapa_importe = np.bincount(celda, weights=ventas["total"], minlength=7 * 24).reshape(7, 24) / 100
+
+    a, b, veces = _pares(items["venta"], items["producto"], top)
+
+    return {
+        "ventas": n_ventas,
+        "renglones": int(items.size),
+        "importe_total": round(float(ventas["total"].sum()) / 100, 2),
+        "ticket_promedio": round(float(ventas["total"].mean()) / 100, 2) if n_ventas else 0.0,
+        "piezas_por_venta": round(float(items["cantidad"].sum()) / n_ventas, 2) if n_ventas else 0.0,
+        "productos_por_venta": round(items.size / n_ventas, 2) if n_ventas else 0.0,
+        "redondeo_aceptado": round(float((ventas["redondeo"] > 0).mean()), 4) if n_ventas else 0.0,
+        "redondeo_total": round(float(ventas["redondeo"].sum()) / 100, 2),
+        "top_productos": [
+            {"id": codigo(int(k)), "nombre": nombre(int(k)),
+             "unidades": int(unidades[k]), "importe": round(float(importe[k]) / 100, 2)}
+            for k in top_k
+        ],
+        "mapa_calor": {
+            "dias": ["Lun", "Mar", "Mié", "Jue", "Vie", "Sáb", "Dom"],
+            "ventas": mapa_ventas.tolist(),
+            "importe": np.round(mapa_importe, 2).tolist(),
+        },
+        "pares": [
+            {"a": nombre(int(x)), "b": nombre(int(y)), "veces": int(n)}
+            for x, y, n in zip(a, b, veces)
+        ],
+    }
+
+def sinteticos(n_items: int, n_productos: int = 5000, semilla: Optional[int] = 0):
+    """Arreglos de prueba con la misma forma que cargar() (para medir calcular())."""
+    rng = np.random.default_rng(semilla)
+    n_ventas = max(1, n_items // 4)
+    ventas = np.zeros(n_ventas, dtype=DTYPE_VENTAS)
+    ventas["venta"] = np.arange(1, n_ventas + 1)
+    ventas["hora"] = rng.integers(7, 23, n_ventas)
+    ventas["dia"] = rng.integers(0, 7, n_ventas)
+    ventas["total"] = rng.integers(1000, 50000, n_ventas)
+    ventas["redondeo"] = np.where(rng.random(n_ventas) < 0.4, rng.integers(1, 99, n_ventas), 0)
+
+    items = np.zeros(n_items, dtype=DTYPE_ITEMS)
+    items["venta"] = np.sort(rng.integers(1, n_ventas + 1, n_items))
+    # Popularidad sesgada (unos pocos productos venden mucho)
+    items["producto"] = np.minimum(rng.zipf(1.3, n_items), n_productos)
+    items["cantidad"] = rng.integers(1, 4, n_items)
+    items["importe"] = items["cantidad"] * rng.integers(500, 5000, n_items)
+    productos = [(f"P{k:05d}", f"Producto {k}") for k in range(1, n_productos + 1)]
+    return ventas, items, productos
+
+def medir(n_items: int = 2_000_000, log=print) -> Dict:
+    """Mide calcular() sobre n_items renglones sintéticos."""
+    ventas, items, productos = sinteticos(n_items)
+    t0 = time.perf_counter()
+    res = calcular(ventas, items, productos)
+    seg = time.perf_counter() - t0
+    log(f"analitica: {n_items:,} renglones / {ventas.size:,} ventas en {seg:.2f} s")
+    return {"renglones": n_items, "ventas": int(ventas.size), "segundos": round(seg, 3), "pares": len(res["pares"])}
@@ -1,9 +1,17 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, g
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, g, make_response, Response, stream_with_context, send_file
+import click
+import itertools
+import hashlib
 import json
+import math
 import os
+import re
+import time
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo  # ← zona horaria real
 
+import pyzstd
+
 # ===== Seguridad y Auth =====
 from dotenv import load_dotenv; load_dotenv()
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
@@ -26,13 +34,45 @@ LOCAL_TZ = ZoneInfo(os.getenv("APP_TZ", "America/Tijuana"))
 # Adaptadores y store
 from store import (
     proveedores_listar, proveedores_guardar, proveedores_eliminar,
-    productos_listar, productos_guardar, productos_eliminar,
+    productos_listar, productos_buscar, productos_por_ids, productos_guardar, productos_eliminar, productos_purgar,
+    productos_importar_csv, productos_ajuste_masivo, ventas_exportar_csv,
+    ventas_registrar_lote,
+    inventario_registrar, inventario_compactar,
+    velocidad_reconstruir, reabasto_sugerido,
+    ventas_respaldar_tipadas, ventas_respaldar_momentos,
 )
-from db import get_db, init_db
+from db import get_db, init_db, LEER_ESCRITURAS_SEG
+from particiones import ddl_ventas, ddl_legacy_sin_fk, es_particionada, asegurar_particiones, migrar_a_particiones
+from archivo import archivar, hay_archivo, ventas_archivadas, venta_archivada, indexar as archivo_indexar
+from folios import id_es_texto, migrar_folios, folio_resolver, folio_texto
+from cambios import ddl_avisos, escuchar
+from respuestas import CacheRespuestas
+from catalogo import publicar as catalogo_publicar, leer_manifest, archivo_version
+from analitica import cargar as analitica_cargar, calcular as analitica_calcular, medir as analitica_medir
 
 # ================== APP ==================
 app = Flask(__name__)
 
+# Plantillas compiladas en disco: tras un reinicio cada worker carga el
+# bytecode en lugar de volver a compilar los .html
+from jinja2 import FileSystemBytecodeCache
+JINJA_CACHE_DIR = os.path.join(DATA_DIR, "jinja")
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+def _precalentar_plantillas():
+    """Compila (o carga del bytecode) todas las plantillas al arrancar, no en la primera petición."""
+    t0 = time.perf_counter()
+    nombres = app.jinja_env.list_templates(extensions=['html'])
+    for nombre in nombres:
+        try:
+            app.jinja_env.get_template(nombre)
+        except Exception as e:
+            print(f'plantillas warning ({nombre}):', e)
+    print(f'plantillas: {len(nombres)} listas en {time.perf_counter() - t0:.3f} s')
+
+_precalentar_plantillas()
+
 # Cookies de sesión
 app.secret_key = os.environ["SECRET_KEY"]
 app.config.update(
@@ -68,6 +108,13 @@ allowed_origins = os.getenv("ALLOWED_ORIGINS", "*")
 if allowed_origins and allowed_origins != "*":
     allowed_origins = [o.strip() for o in allowed_origins.split(",") if o.strip()]
 socketio = SocketIO(app, cors_allowed_origins=allowed_origins or "*")
+
+# Tareas en segundo plano: se registran al importar y arrancan con la primera
+# petición, así los comandos `flask ...` no levantan ciclos que nadie atiende.
+_tareas_fondo = []
+
+def en_segundo_plano(fn, *args):
+    _tareas_fondo.append((fn, args))
 _last_state = None
 
 @socketio.on("join")
@@ -108,9 +155,18 @@ if not DATABASE_URL:
     raise RuntimeError("Falta DATABASE_URL")
 TENANT_SCHEMA = os.getenv("TENANT_SCHEMA", "tnt_default")  # p.ej. tnt_cliente1
 
+# True mientras haya ventas heredadas sin momento: los filtros y joins usan fecha de respaldo
+_momentos = {'pendientes': False}
+# True mientras haya ventas sin redondeo tipado: se lee del texto extra (ventas_respaldar_tipadas)
+_tipadas = {'pendientes': False}
+# True mientras ventas.id siga siendo el folio de texto (falta flask migrar-folios):
+# las ventas nuevas llevan folio de texto y las rutas aceptan ids de texto
+_folios = {'pendientes': False}
+
 def ensure_tenant_schema():
     ddl = f'''
     create schema if not exists "{TENANT_SCHEMA}";
+    create extension if not exists pg_trgm with schema public;
     set search_path = "{TENANT_SCHEMA}", public;
 
     create table if not exists productos(
@@ -120,7 +176,20 @@ def ensure_tenant_schema():
       stock     integer not null default 0,
       categoria text
     );
-    create index if not exists idx_productos_nombre on productos(nombre);
+    -- Baja lógica: los productos borrados se quedan para no tocar ventas pasadas
+    alter table productos add column if not exists activo boolean not null default true;
+    alter table productos add column if not exists deleted_at timestamptz;
+    drop index if exists idx_productos_nombre;
+    drop index if exists idx_productos_nombre_trgm;
+    drop index if exists idx_productos_id_trgm;
+    drop index if exists idx_productos_categoria;
+    -- Índices parciales: las consultas del catálogo solo ven productos activos
+    create index if not exists idx_productos_nombre_activos on productos(nombre) where activo;
+    -- Búsqueda del almacén: subcadena / similitud sobre nombre y código
+    create index if not exists idx_productos_nombre_trgm_activos on productos using gin (nombre gin_trgm_ops) where activo;
+    create index if not exists idx_productos_id_trgm_activos on productos using gin (id gin_trgm_ops) where activo;
+    create index if not exists idx_productos_categoria_activos on productos(categoria) where activo;
+    create index if not exists idx_productos_bajas on productos(deleted_at) where not activo;
 
     create table if not exists proveedores(
       id        text primary key,
@@ -129,23 +198,44 @@ def ensure_tenant_schema():
       email     text,
       direccion text
     );
-
-    create table if not exists ventas(
-      id      text primary key,
-      fecha   text not null,
-      cliente text,
-      total   numeric(12,2) not null default 0,
-      extra   text
+    alter table productos add column if not exists proveedor_id text references proveedores(id) on delete set null;
+    create index if not exists idx_productos_proveedor on productos(proveedor_id) where activo;
+
+    -- Velocidad de venta por producto (unidades/día con decaimiento), la actualiza el compactador
+    create table if not exists producto_velocidad(
+      producto_id text primary key references productos(id) on delete cascade,
+      velocidad   double precision not null default 0,
+      actualizado timestamptz not null
     );
 
-    create table if not exists venta_items(
-      id              bigserial primary key,
-      venta_id        text not null references ventas(id) on delete cascade,
-      producto_id     text not null references productos(id),
-      cantidad        integer not null,
-      precio_unitario numeric(12,2) not null
+    -- Libro de inventario: solo se inserta; el compactador suma lo pendiente a
+    -- productos.stock y borra esos movimientos en la misma transacción
+    create table if not exists inventario_movimientos(
+      id          bigserial primary key,
+      producto_id text not null references productos(id) on delete cascade,
+      tipo        text not null check (tipo in ('venta', 'reabasto', 'ajuste')),
+      delta       integer not null,
+      referencia  text,
+      creado_en   timestamptz not null default now()
+    );
+    -- Instalaciones con la marca "compactado": lo ya consolidado sobra
+    drop index if exists idx_inv_mov_pendientes;
+    do $$ begin
+      if exists (select 1 from information_schema.columns
+                 where table_schema = current_schema() and table_name = 'inventario_movimientos'
+                   and column_name = 'compactado') then
+        delete from inventario_movimientos where compactado;
+        alter table inventario_movimientos drop column compactado;
+      end if;
+    end $$;
+    create index if not exists idx_inv_mov_producto on inventario_movimientos(producto_id);
+
+    -- Folios: id compacto de productos manuales y folios de texto anteriores -> bigint
+    create sequence if not exists productos_manual_seq;
+    create table if not exists ventas_folios(
+      anterior text primary key,
+      id       bigint not null
     );
-    create index if not exists idx_venta_items_venta on venta_items(venta_id);
 
     -- Usuarios para autenticación
     create table if not exists usuarios(
@@ -156,12 +246,235 @@ def ensure_tenant_schema():
       ultimo_acceso timestamptz
     );
     '''
+    # ventas / venta_items: particionadas por mes en instalaciones nuevas;
+    # las heredadas reciben las columnas nuevas y se migran en segundo plano.
+    ddl_ventas_heredadas = '''
+    alter table ventas add column if not exists clave text;
+    alter table ventas add column if not exists momento timestamptz;
+    create unique index if not exists ux_ventas_clave on ventas(clave, momento);
+    create index if not exists idx_ventas_momento on ventas(momento);
+    alter table venta_items add column if not exists venta_momento timestamptz;
+    create index if not exists idx_venta_items_producto on venta_items(producto_id);
+    -- Filas sin momento (las rellena ventas_respaldar_momentos) y su respaldo por fecha
+    create index if not exists idx_ventas_sin_momento on ventas(fecha) where momento is null;
+    create index if not exists idx_venta_items_sin_momento on venta_items(id) where venta_momento is null;
+    '''
+    # Redondeo y extra tipados (las filas viejas las convierte ventas_respaldar_tipadas)
+    ddl_ventas_tipadas = '''
+    alter table ventas add column if not exists redondeo numeric(12,2);
+    alter table ventas add column if not exists extra_jsonb jsonb;
+    create index if not exists idx_ventas_redondeo on ventas(momento) where redondeo > 0;
+    create index if not exists idx_ventas_sin_tipar on ventas(momento) where redondeo is null;
+    -- Idempotencia de las cajas: una clave, una venta (sin importar su momento)
+    do $$ begin
+      if to_regclass('ventas_claves') is null then
+        create table ventas_claves(
+          clave    text primary key,
+          venta_id bigint not null
+        );
+        if (select data_type from information_schema.columns
+            where table_schema = current_schema() and table_name = 'ventas' and column_name = 'id') = 'bigint' then
+          insert into ventas_claves (clave, venta_id)
+            select distinct on (clave) clave, id from ventas where clave is not null
+            order by clave, id
+            on conflict do nothing;
+        end if;
+      end if;
+    end $$;
+    -- Número de un texto heredado, o NULL si no lo es (o no cabe en numeric(12,2)):
+    -- un valor corrupto no debe tumbar lecturas ni lotes del respaldo
+    create or replace function numero_o_nulo(t text) returns numeric
+      language sql immutable as $$
+        select case when t ~ '^\\s*-?\\d{1,10}(\\.\\d+)?\\s*$' then round(trim(t)::numeric, 2) end
+      $$;
+    create or replace function json_o_vacio(t text) returns jsonb
+      language plpgsql immutable as $$
+      begin
+        return coalesce(t::jsonb, '{}'::jsonb);
+      exception when others then
+        return '{}'::jsonb;
+      end $$;
+    '''
     with psycopg.connect(DATABASE_URL) as conn:
         with conn.cursor() as cur:
             cur.execute(ddl)
+            cur.execute("select to_regclass('ventas') is not null")
+            existe = cur.fetchone()[0]
+            particionada = not existe or es_particionada(conn, TENANT_SCHEMA, "ventas")
+            cur.execute(ddl_ventas() if particionada else ddl_ventas_heredadas)
+            cur.execute(ddl_ventas_tipadas)
+            cur.execute(ddl_avisos())
+            # Instalaciones ya particionadas antes de soltar la FK en el intercambio
+            cur.execute(ddl_legacy_sin_fk())
             conn.commit()
+            cur.execute("select exists(select 1 from ventas where redondeo is null)")
+            _tipadas['pendientes'] = cur.fetchone()[0]
+            if not particionada:
+                cur.execute(
+                    "select exists(select 1 from ventas where momento is null) "
+                    "or exists(select 1 from venta_items where venta_momento is null)"
+                )
+                _momentos['pendientes'] = cur.fetchone()[0]
+        # La conversión reescribe ventas bajo lock exclusivo: nunca en el arranque.
+        # Mientras tanto la app sigue con folios de texto.
+        _folios['pendientes'] = existe and id_es_texto(conn, TENANT_SCHEMA)
+        if _folios['pendientes']:
+            print("folios: ventas.id sigue como texto (se siguen usando folios de texto); "
+                  "correr `flask migrar-folios` con la tienda cerrada (o FOLIOS_AUTO=1)")
+        if particionada:
+            asegurar_particiones(conn, LOCAL_TZ)
+    return particionada
+
+_PARTICIONADA = ensure_tenant_schema()
+PARTICIONAR_AUTO = os.getenv("PARTICIONAR_AUTO", "1") == "1"
+FOLIOS_AUTO = os.getenv("FOLIOS_AUTO", "0") == "1"
+
+def _migrar_folios():
+    with psycopg.connect(DATABASE_URL) as conn:
+        conn.execute(f'SET search_path TO "{TENANT_SCHEMA}", public')
+        conn.commit()
+        if not migrar_folios(conn, TENANT_SCHEMA, _PARTICIONADA):
+            return False
+    _folios['pendientes'] = False
+    return True
+
+def _migrar_folios_bg():
+    try:
+        if _migrar_folios() and not _PARTICIONADA and PARTICIONAR_AUTO:
+            # La partición espera a los folios numéricos
+            migrar_a_particiones(DATABASE_URL, TENANT_SCHEMA, LOCAL_TZ)
+    except Exception as e:
+        print('migrar folios warning:', e)
+
+if _folios['pendientes']:
+    if FOLIOS_AUTO:
+        en_segundo_plano(_migrar_folios_bg)
+elif not _PARTICIONADA and PARTICIONAR_AUTO:
+    en_segundo_plano(migrar_a_particiones, DATABASE_URL, TENANT_SCHEMA, LOCAL_TZ)
+
+def _folios_texto(conn=None):
+    """
+    True mientras ventas.id siga siendo texto. Se vuelve a revisar en cada
+    uso (solo mientras está pendiente): migrar-folios puede correr en otro proceso.
+    """
+    if not _folios['pendientes']:
+        return False
+    if conn is None:
+        with get_db() as c:
+            return _folios_texto(c)
+    row = conn.execute(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = 'ventas' AND column_name = 'id'"
+    ).fetchone()
+    if not row or row['data_type'] != 'text':
+        _folios['pendientes'] = False
+        if not _PARTICIONADA and PARTICIONAR_AUTO:
+            # La partición esperaba a los folios numéricos
+            socketio.start_background_task(migrar_a_particiones, DATABASE_URL, TENANT_SCHEMA, LOCAL_TZ)
+    return _folios['pendientes']
+
+def _venta_id(vid, conn=None):
+    """Id de ventas para consultar: texto antes de migrar-folios, si no bigint (None = inválido)."""
+    vid = str(vid or '').strip()
+    if _folios_texto(conn):
+        return vid or None
+    return int(vid) if vid.isdigit() else None
+
+def _particiones_loop():
+    # Mantiene creadas las particiones de los próximos meses
+    while True:
+        socketio.sleep(12 * 3600)
+        try:
+            with psycopg.connect(DATABASE_URL) as conn:
+                conn.execute(f'SET search_path TO "{TENANT_SCHEMA}", public')
+                if es_particionada(conn, TENANT_SCHEMA, "ventas"):
+                    asegurar_particiones(conn, LOCAL_TZ)
+        except Exception as e:
+            print('particiones warning:', e)
+
+en_segundo_plano(_particiones_loop)
+
+def _aviso_recibido(aviso):
+    # Cambios de otros workers / CLI (archivo, importaciones): invalidan el caché de este proceso
+    _respuestas.subir(TENANT_SCHEMA)
+    socketio.emit('cambios', aviso, to='admin')
+
+def _avisos_loop():
+    # Una sola conexión LISTEN por proceso; los avisos van al cuarto "admin"
+    while True:
+        try:
+            # Al (re)conectar se sube la versión: los avisos perdidos entre tanto
+            # dejarían respuestas viejas en el caché de este proceso
+            escuchar(DATABASE_URL, TENANT_SCHEMA, _aviso_recibido,
+                     al_conectar=lambda: _respuestas.subir(TENANT_SCHEMA))
+        except Exception as e:
+            print('avisos warning:', e)
+        socketio.sleep(5)
+
+en_segundo_plano(_avisos_loop)
+
+def _respaldar_tipadas():
+    g.tenant_schema = TENANT_SCHEMA
+    total = 0
+    # Primero momento / venta_momento (sin esperar a la migración a particiones)
+    while (n := ventas_respaldar_momentos(LOCAL_TZ)) > 0:
+        total += n
+    _momentos['pendientes'] = False
+    while (n := ventas_respaldar_tipadas()) > 0:
+        total += n
+    _tipadas['pendientes'] = False
+    return total
+
+def _respaldar_tipadas_bg():
+    try:
+        with app.app_context():
+            n = _respaldar_tipadas()
+            if n:
+                print(f'respaldo tipado: {n} venta(s) convertidas')
+    except Exception as e:
+        print('respaldo tipado warning:', e)
+
+en_segundo_plano(_respaldar_tipadas_bg)
+
+def _archivo_indexar_bg():
+    # Segmentos archivados antes de los .ids.json: una pasada y listo
+    try:
+        archivo_indexar(DATA_DIR)
+    except Exception as e:
+        print('archivo indexar warning:', e)
+
+en_segundo_plano(_archivo_indexar_bg)
 
-ensure_tenant_schema()
+@app.cli.command('respaldar-ventas')
+def respaldar_ventas_cmd():
+    """Llena momento, redondeo y extra_jsonb de ventas viejas por lotes (en línea)."""
+    print(f'respaldar-ventas: {_respaldar_tipadas()} venta(s) convertidas')
+
+@app.cli.command('archivar-ventas')
+@click.argument('antes_de')
+def archivar_ventas_cmd(antes_de):
+    """Mueve las ventas anteriores a ANTES_DE (YYYY-MM-DD) a segmentos zstd en DATA_DIR/archivo."""
+    g.tenant_schema = TENANT_SCHEMA
+    corte = datetime.fromisoformat(antes_de).replace(tzinfo=LOCAL_TZ)
+    n = archivar(DATA_DIR, corte)
+    print(f'archivar-ventas: {n} venta(s) archivadas')
+    try:
+        export_historial_json()
+    except Exception as e:
+        print('export historial warning:', e)
+
+@app.cli.command('migrar-folios')
+def migrar_folios_cmd():
+    """Convierte los folios de texto de ventas a bigint (con la tienda cerrada)."""
+    if not _folios['pendientes']:
+        print('migrar-folios: ventas.id ya es numérico')
+    elif _migrar_folios():
+        print('migrar-folios: listo; ya se puede correr particionar-ventas')
+
+@app.cli.command('particionar-ventas')
+def particionar_ventas_cmd():
+    """Migra ventas/venta_items a tablas particionadas por mes (en línea)."""
+    migrar_a_particiones(DATABASE_URL, TENANT_SCHEMA, LOCAL_TZ)
 
 def bootstrap_admin_user_if_needed():
     admin_user = os.getenv("ADMIN_USER", "admin").strip()
@@ -183,6 +496,71 @@ def bootstrap_admin_user_if_needed():
 
 bootstrap_admin_user_if_needed()
 
+# --------------------- COMPACTADOR DE INVENTARIO ---------------------
+INVENTARIO_COMPACTAR_SEG = int(os.getenv("INVENTARIO_COMPACTAR_SEG", "30"))
+
+def _compactar_inventario_loop():
+    while True:
+        socketio.sleep(INVENTARIO_COMPACTAR_SEG)
+        try:
+            with app.app_context():
+                g.tenant_schema = TENANT_SCHEMA
+                while inventario_compactar() > 0:
+                    pass
+        except Exception as e:
+            print('compactar inventario warning:', e)
+
+if INVENTARIO_COMPACTAR_SEG > 0:
+    en_segundo_plano(_compactar_inventario_loop)
+
+@app.cli.command('compactar-inventario')
+def compactar_inventario_cmd():
+    """Consolida todos los movimientos pendientes en productos.stock."""
+    g.tenant_schema = TENANT_SCHEMA
+    total = 0
+    while (n := inventario_compactar()) > 0:
+        total += n
+    print(f'compactar-inventario: {total} movimiento(s) consolidados')
+
+# --------------------- PURGA DE PRODUCTOS DADOS DE BAJA ---------------------
+# Días que un producto borrado se conserva antes de purgarse (0 = no purgar en segundo plano)
+PRODUCTOS_PURGAR_DIAS = int(os.getenv("PRODUCTOS_PURGAR_DIAS", "0"))
+
+def _purgar_productos_loop():
+    while True:
+        socketio.sleep(3600)
+        try:
+            with app.app_context():
+                g.tenant_schema = TENANT_SCHEMA
+                while productos_purgar(PRODUCTOS_PURGAR_DIAS) > 0:
+                    socketio.sleep(1)
+        except Exception as e:
+            print('purgar productos warning:', e)
+
+if PRODUCTOS_PURGAR_DIAS > 0:
+    en_segundo_plano(_purgar_productos_loop)
+
+@app.cli.command('purgar-productos')
+@click.option('--dias', default=30, show_default=True, help='Antigüedad mínima de la baja.')
+def purgar_productos_cmd(dias):
+    """Borra los productos dados de baja hace más de DIAS que no aparecen en ventas."""
+    g.tenant_schema = TENANT_SCHEMA
+    total = 0
+    while (n := productos_purgar(dias)) > 0:
+        total += n
+    print(f'purgar-productos: {total} producto(s) borrados')
+
+_tareas_iniciadas = False
+
+@app.before_request
+def iniciar_tareas_fondo():
+    global _tareas_iniciadas
+    if _tareas_iniciadas:
+        return
+    _tareas_iniciadas = True
+    for fn, args in _tareas_fondo:
+        socketio.start_background_task(fn, *args)
+
 @app.before_request
 def set_fixed_tenant():
     g.tenant_schema = TENANT_SCHEMA
@@ -201,6 +579,146 @@ def require_auth_or_display(fn):
     return _w
 # --------------------------------------------------------
 
+# --------- caché de respuestas por versión de datos ----------
+RESPUESTAS_CACHE_MB = float(os.getenv("RESPUESTAS_CACHE_MB", "64"))
+# Tope de vida de cada respuesta guardada (respaldo si se pierde un aviso; 0 = sin tope)
+RESPUESTAS_TTL_SEG = float(os.getenv("RESPUESTAS_TTL_SEG", "300"))
+_respuestas = CacheRespuestas(int(RESPUESTAS_CACHE_MB * 1024 * 1024), ttl_max=RESPUESTAS_TTL_SEG or None)
+
+def _datos_cambiaron():
+    """Llamar después de escribir ventas: las respuestas guardadas del tenant dejan de servir."""
+    _respuestas.subir(g.tenant_schema)
+
+def respuesta_por_version(fn):
+    """
+    Guarda el cuerpo de la respuesta por (endpoint, parámetros, versión de
+    datos) y contesta 304 si el navegador ya lo tiene. Las consultas ?ids=
+    (parches en vivo) van siempre a la base.
+    """
+    @wraps(fn)
+    def _w(*a, **kw):
+        if request.args.get('ids'):
+            return fn(*a, **kw)
+        clave = _respuestas.clave(g.tenant_schema, request.endpoint, request.args)
+        entrada = _respuestas.obtener(clave)
+        if entrada is None:
+            resp = make_response(fn(*a, **kw))
+            if resp.status_code != 200:
+                return resp
+            # Leído de una réplica puede venir atrasado: solo se guarda un rato
+            ttl = max(LEER_ESCRITURAS_SEG, 1) if g.get('leyo_replica') else None
+            entrada = _respuestas.guardar(clave, resp.get_data(), ttl=ttl)
+        resp = make_response(entrada[0])
+        resp.mimetype = 'application/json'
+        resp.set_etag(entrada[1])
+        resp.headers['Cache-Control'] = 'private, no-cache'
+        return resp.make_conditional(request)
+    return _w
+# --------------------------------------------------------
+
+# --------- helper: páginas que no dependen de la petición ----------
+_paginas = {}  # (plantilla, contexto) -> (html en bytes, etag)
+
+def pagina_fija(plantilla, **ctx):
+    """
+    Render de una página cuyo HTML solo depende de la plantilla (los datos
+    llegan después por fetch): se renderiza una vez por proceso y se sirve
+    con ETag. En modo debug se renderiza siempre para ver cambios al vuelo.
+    """
+    clave = (plantilla, tuple(sorted(ctx.items())))
+    entrada = None if app.debug else _paginas.get(clave)
+    if entrada is None:
+        html = render_template(plantilla, **ctx).encode('utf-8')
+        entrada = (html, hashlib.sha1(html).hexdigest())
+        _paginas[clave] = entrada
+    resp = make_response(entrada[0])
+    resp.mimetype = 'text/html'
+    resp.set_etag(entrada[1])
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp.make_conditional(request)
+# --------------------------------------------------------
+
+# --------- helper: rango de fechas sobre ventas.momento ----------
+def _rango_fechas(desde, hasta):
+    """'YYYY-MM-DD' (zona local) -> (inicio, fin) como datetimes; fin es exclusivo."""
+    ini = datetime.fromisoformat(desde).replace(tzinfo=LOCAL_TZ) if desde else None
+    fin = datetime.fromisoformat(hasta).replace(tzinfo=LOCAL_TZ) + timedelta(days=1) if hasta else None
+    return ini, fin
+
+def _filtro_fechas(desde, hasta, col='momento'):
+    """
+    Traduce 'YYYY-MM-DD' (zona local) a condiciones sobre la columna timestamptz
+    para que Postgres descarte las particiones fuera del rango.
+    Lanza ValueError si alguna fecha no es válida.
+    """
+    ini, fin = _rango_fechas(desde, hasta)
+    conds, params = [], []
+    # Ventas heredadas aún sin momento: se comparan por el texto 'YYYY-MM-DD HH:MM' de fecha
+    respaldo = _momentos['pendientes'] and col == 'momento'
+    for limite, op in ((ini, '>='), (fin, '<')):
+        if not limite:
+            continue
+        if respaldo:
+            conds.append(f"({col} {op} ? OR ({col} IS NULL AND fecha {op} ?))")
+            params += [limite, limite.strftime('%Y-%m-%d')]
+        else:
+            conds.append(f"{col} {op} ?")
+            params.append(limite)
+    return conds, params
+
+def _items_de_venta():
+    """Condición de venta_items para una venta (venta_id, momento)."""
+    if _momentos['pendientes']:
+        return "vi.venta_id=? AND (vi.venta_momento=? OR vi.venta_momento IS NULL)"
+    return "vi.venta_id=? AND vi.venta_momento=?"
+
+# Columnas tipadas; COALESCE cubre filas que el respaldo aún no convierte
+# Redondeo tipado o, en filas aún sin respaldar, el del texto extra
+_REDONDEO_SQL = "COALESCE(redondeo, numero_o_nulo(json_o_vacio(extra)->>'redondeo'), 0)"
+_VENTA_COLS = f"id, momento, fecha, total, {_REDONDEO_SQL} AS redondeo"
+
+def _venta_campos(v):
+    """(fecha, hora, redondeo) de una fila de ventas o de una venta archivada."""
+    redondeo = v.get('redondeo')
+    if redondeo is None and v.get('extra'):
+        try:
+            redondeo = json.loads(v['extra']).get('redondeo', 0)
+        except Exception:
+            redondeo = 0
+    try:
+        redondeo = float(redondeo or 0)
+    except (TypeError, ValueError):
+        redondeo = 0.0
+    if v.get('momento') is None:
+        # Venta heredada que el respaldo aún no convierte: fecha ya es 'YYYY-MM-DD HH:MM' local
+        fecha = str(v.get('fecha') or '')
+        return fecha[:10], fecha[11:16], redondeo
+    m = v['momento'].astimezone(LOCAL_TZ)
+    return m.strftime('%Y-%m-%d'), m.strftime('%H:%M'), redondeo
+
+def _archivadas(desde, hasta, recientes_primero=False):
+    """
+    Ventas archivadas (segmentos zstd) dentro del rango, en orden cronológico
+    o inverso. Es un iterador: los segmentos se descomprimen al recorrerlo.
+    Lanza ValueError si alguna fecha no es válida.
+    """
+    ini, fin = _rango_fechas(desde, hasta)
+    if not hay_archivo(DATA_DIR, ini):
+        return iter(())
+    return ventas_archivadas(DATA_DIR, ini, fin, recientes_primero)
+
+def _rango_args():
+    return (request.args.get('desde') or '').strip(), (request.args.get('hasta') or '').strip()
+
+def _ids_args():
+    """
+    ?ids=1&ids=2 (avisos en vivo): solo esas ventas, sin las archivadas.
+    Esas lecturas van al primario: la réplica puede no tener todavía el cambio avisado.
+    """
+    ids = [i for i in (_venta_id(i) for i in request.args.getlist('ids')[:500]) if i is not None]
+    return ids or None
+# --------------------------------------------------------
+
 # ===================== EXPORTADORES (opcionales) =====================
 def export_productos_json():
     data = [p for p in productos_listar() if (p.get('categoria') or '').upper() != 'MANUAL']
@@ -213,39 +731,45 @@ def export_productos_json():
             'cantidad': int(p.get('stock') or 0),
             'seccion': p.get('categoria') or ''
         }
-    out_dir = os.path.join(DATA_DIR, 'static')
-    os.makedirs(out_dir, exist_ok=True)
-    with open(os.path.join(out_dir, 'productos.json'), 'w', encoding='utf-8') as f:
-        json.dump(out, f, ensure_ascii=False, indent=4)
+    # Versión nueva (JSON mínimo + .br/.gz) solo si el contenido cambió
+    return catalogo_publicar(DATA_DIR, out)
+
+# Publicar comprime todo el catálogo: fuera de la petición y una vez por ráfaga
+CATALOGO_DEMORA_SEG = float(os.getenv("CATALOGO_DEMORA_SEG", "2"))
+_catalogo = {'programado': False}
+
+def publicar_catalogo():
+    """Programa la publicación del catálogo; los cambios dentro de la demora se juntan en una sola."""
+    if _catalogo['programado']:
+        return
+    _catalogo['programado'] = True
+    socketio.start_background_task(_publicar_catalogo_bg)
+
+def _publicar_catalogo_bg():
+    socketio.sleep(CATALOGO_DEMORA_SEG)
+    # Antes de leer: un cambio a partir de aquí programa otra publicación
+    _catalogo['programado'] = False
+    try:
+        with app.app_context():
+            g.tenant_schema = TENANT_SCHEMA
+            export_productos_json()
+    except Exception as e:
+        print('export productos warning:', e)
 
 def export_historial_json():
     items_salida = []
     with get_db() as conn:
         ventas = conn.execute(
-            'SELECT id, fecha, total, extra FROM ventas ORDER BY fecha ASC, id ASC'
+            f'SELECT {_VENTA_COLS} FROM ventas ORDER BY momento ASC, id ASC'
         ).fetchall()
         for v in ventas:
-            fecha_txt = v['fecha'] or ''
-            if ' ' in fecha_txt:
-                fecha_str, hora_str = fecha_txt.split(' ', 1)
-            else:
-                fecha_str, hora_str = fecha_txt, ''
-
-            redondeo = 0.0
-            if v['extra']:
-                try:
-                    extra = json.loads(v['extra'])
-                    redondeo = float(extra.get('redondeo', 0))
-                    if not hora_str and extra.get('hora'):
-                        hora_str = str(extra['hora'])
-                except Exception:
-                    pass
+            fecha_str, hora_str, redondeo = _venta_campos(v)
 
             det = conn.execute(
                 'SELECT vi.cantidad, COALESCE(p.nombre, vi.producto_id) AS nombre '
                 'FROM venta_items vi LEFT JOIN productos p ON p.id = vi.producto_id '
-                'WHERE vi.venta_id=?',
-                (v['id'],)
+                'WHERE ' + _items_de_venta(),
+                (v['id'], v['momento'])
             ).fetchall()
 
             resumen = {}
@@ -269,6 +793,43 @@ def export_historial_json():
         json.dump(items_salida, f, ensure_ascii=False, indent=4)
 
 # ===================== Rutas =====================
+# ---- Catálogo para las terminales (instantáneas versionadas) ----
+_VERSION_CATALOGO = re.compile(r'^[0-9a-f]{16}$')
+
+def _catalogo_manifest():
+    m = leer_manifest(DATA_DIR)
+    return m if m else export_productos_json()
+
+@app.get('/catalogo/manifest.json')
+def catalogo_manifest():
+    m = _catalogo_manifest()
+    resp = jsonify(m)
+    resp.set_etag(m['version'])
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp.make_conditional(request)
+
+@app.get('/catalogo/<version>.json')
+def catalogo_version(version):
+    encontrado = _VERSION_CATALOGO.match(version) and archivo_version(
+        DATA_DIR, version, request.headers.get('Accept-Encoding', ''))
+    if not encontrado:
+        return jsonify({'error': 'Versión no encontrada'}), 404
+    ruta, codificacion = encontrado
+    resp = send_file(ruta, mimetype='application/json', etag=f'{version}-{codificacion or "id"}')
+    if codificacion:
+        resp.headers['Content-Encoding'] = codificacion
+    resp.headers['Vary'] = 'Accept-Encoding'
+    # El nombre cambia con el contenido: el navegador no necesita volver a preguntar
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
+
+@app.get('/productos.json')
+def productos_json():
+    """Ruta anterior del catálogo: redirige a la versión vigente."""
+    resp = redirect(_catalogo_manifest()['url'])
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
 @app.route('/')
 def index():
     return redirect(url_for('venta'))
@@ -301,7 +862,7 @@ def agregar_producto():
 
     with get_db() as conn:
         row = conn.execute(
-            'SELECT id, nombre, precio FROM productos WHERE id=?',
+            'SELECT id, nombre, precio FROM productos WHERE id=? AND activo',
             (codigo,)
         ).fetchone()
 
@@ -356,24 +917,37 @@ def redondear():
     ahora = datetime.now(LOCAL_TZ)
     fecha_str = ahora.strftime('%Y-%m-%d')
     hora_str = ahora.strftime('%H:%M')
-    venta_id = ahora.strftime('V%Y%m%d%H%M%S%f')
 
     try:
         with get_db() as conn:
             conn.execute('BEGIN')
 
             extra = {'redondeo': float(redondeo), 'hora': hora_str}
-            conn.execute(
-                'INSERT INTO ventas (id, fecha, cliente, total, extra) VALUES (?, ?, ?, ?, ?)',
-                (venta_id, f'{fecha_str} {hora_str}', None, float(total_final), json.dumps(extra, ensure_ascii=False))
-            )
-
+            fila = (ahora, f'{fecha_str} {hora_str}', None, float(total_final), float(redondeo),
+                    json.dumps(extra, ensure_ascii=False))
+            if _folios_texto(conn):
+                # Antes de migrar-folios: folio de texto como siempre
+                venta_id = folio_texto(ahora)
+                conn.execute(
+                    'INSERT INTO ventas (id, momento, fecha, cliente, total, redondeo, extra_jsonb) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?::jsonb)',
+                    (venta_id,) + fila
+                )
+            else:
+                # El folio sale de ventas_id_seq: dos cajas nunca chocan
+                venta_id = conn.execute(
+                    'INSERT INTO ventas (momento, fecha, cliente, total, redondeo, extra_jsonb) '
+                    'VALUES (?, ?, ?, ?, ?, ?::jsonb) RETURNING id',
+                    fila
+                ).fetchone()['id']
+
+            mov_ids, mov_deltas = [], []
             for nombre, info in resumen.items():
                 cantidad = int(info['cantidad'])
 
                 with_db = False
                 prow = conn.execute(
-                    'SELECT id, precio FROM productos WHERE nombre=? LIMIT 1',
+                    'SELECT id, precio FROM productos WHERE nombre=? AND activo LIMIT 1',
                     (nombre,)
                 ).fetchone()
 
@@ -383,22 +957,23 @@ def redondear():
                     with_db = True
                 else:
                     pu = float(info.get('precio', 0.0))
-                    pid = ahora.strftime('M%Y%m%d%H%M%S%f')
+                    pid = 'M' + str(conn.execute("SELECT nextval('productos_manual_seq') AS n").fetchone()['n'])
                     conn.execute(
                         'INSERT INTO productos (id, nombre, precio, stock, categoria) VALUES (?,?,?,?,?)',
                         (pid, nombre, pu, 0, 'MANUAL')
                     )
 
                 conn.execute(
-                    'INSERT INTO venta_items (venta_id, producto_id, cantidad, precio_unitario) VALUES (?, ?, ?, ?)',
-                    (venta_id, pid, cantidad, pu)
+                    'INSERT INTO venta_items (venta_id, venta_momento, producto_id, cantidad, precio_unitario) VALUES (?, ?, ?, ?, ?)',
+                    (venta_id, ahora, pid, cantidad, pu)
                 )
 
                 if with_db:
-                    conn.execute(
-                        'UPDATE productos SET stock = GREATEST(0, stock - ?) WHERE id = ?',
-                        (cantidad, pid)
-                    )
+                    mov_ids.append(pid)
+                    mov_deltas.append(-cantidad)
+
+            # Sin UPDATE sobre productos: el stock se descuenta vía el libro de movimientos
+            inventario_registrar(conn, mov_ids, mov_deltas, 'venta', [str(venta_id)] * len(mov_ids))
 
             conn.execute('COMMIT')
     except Exception as e:
@@ -408,9 +983,10 @@ def redondear():
             pass
         session['mensaje'] = f'❌ Error al completar la venta: {e}'
         return redirect(url_for('venta'))
+    _datos_cambiaron()
 
+    publicar_catalogo()
     try:
-        export_productos_json()
         export_historial_json()
     except Exception as _e:
         print('export warning:', _e)
@@ -419,15 +995,129 @@ def redondear():
         f'✅ Venta completada con redondeo de ${redondeo:.2f}.' if aceptado == 'si'
         else '✅ Venta completada sin redondeo.'
     )
+    try:
+        _ticket_preparar(str(venta_id))
+    except Exception as _e:
+        print('ticket warning:', _e)
+
     session['carrito'] = []
     session['ultimo_ticket'] = venta_id
     return redirect(url_for('venta'))
 
+# ====== Ventas por lote (cajas con internet intermitente) ======
+def _numero_lote(valor, campo):
+    """float finito o ValueError (NaN/inf romperían totales y reportes)."""
+    try:
+        n = float(valor)
+    except (TypeError, ValueError):
+        raise ValueError(f'{campo} inválido')
+    if not math.isfinite(n):
+        raise ValueError(f'{campo} inválido')
+    return n
+
+def _venta_de_lote(data):
+    """Normaliza una venta del lote al formato de ventas_registrar_lote."""
+    clave = str(data.get('clave') or '').strip()
+    if not clave:
+        raise ValueError('Falta la clave de idempotencia')
+
+    try:
+        momento = datetime.fromisoformat(str(data.get('fecha') or ''))
+    except ValueError:
+        raise ValueError('Fecha inválida')
+    momento = momento.astimezone(LOCAL_TZ) if momento.tzinfo else momento.replace(tzinfo=LOCAL_TZ)
+    hora_str = momento.strftime('%H:%M')
+
+    renglones = data.get('items') or []
+    if not isinstance(renglones, list):
+        raise ValueError('items debe ser una lista')
+    items = []
+    subtotal = 0.0
+    for it in renglones:
+        if not isinstance(it, dict):
+            raise ValueError('Renglón inválido')
+        pid = str(it.get('producto_id') or '').strip()
+        cantidad = _numero_lote(it.get('cantidad') or 0, 'cantidad')
+        precio = _numero_lote(it.get('precio') or 0, 'precio')
+        if cantidad != int(cantidad):
+            raise ValueError('La cantidad debe ser entera')
+        cantidad = int(cantidad)
+        if not pid or cantidad <= 0 or precio < 0:
+            raise ValueError('Renglón inválido')
+        items.append({'producto_id': pid, 'cantidad': cantidad, 'precio_unitario': precio})
+        subtotal += cantidad * precio
+    if not items:
+        raise ValueError('Venta sin productos')
+
+    redondeo = _numero_lote(data.get('redondeo') or 0, 'redondeo')
+    total = _numero_lote(data['total'], 'total') if data.get('total') is not None else subtotal + redondeo
+    extra = {'redondeo': redondeo, 'hora': hora_str, 'clave': clave}
+    return {
+        'clave': clave,
+        'momento': momento,
+        'fecha': momento.strftime('%Y-%m-%d %H:%M'),
+        'total': round(total, 2),
+        'redondeo': redondeo,
+        'extra': json.dumps(extra, ensure_ascii=False),
+        'items': items,
+    }
+
+@app.post('/api/ventas/lote')
+@login_required
+def api_ventas_lote():
+    data = request.get_json(silent=True) or {}
+    lote = data.get('ventas') if isinstance(data, dict) else None
+    if not isinstance(lote, list):
+        return jsonify({'ok': False, 'error': 'Se esperaba {"ventas": [...]}'}), 400
+    ventas = []
+    errores = []
+    vistas = set()
+    repetidas = []  # (índice, clave) de ventas con una clave ya vista en este lote
+    for i, v in enumerate(lote):
+        try:
+            if not isinstance(v, dict):
+                raise ValueError('Venta inválida')
+            venta = _venta_de_lote(v)
+        except (TypeError, ValueError, KeyError, AttributeError) as e:
+            errores.append({'indice': i, 'error': str(e)})
+            continue
+        if venta['clave'] in vistas:
+            repetidas.append((i, venta['clave']))
+            continue
+        vistas.add(venta['clave'])
+        ventas.append(venta)
+
+    try:
+        resultado = ventas_registrar_lote(ventas, folios_texto=_folios_texto())
+    except Exception as e:
+        return jsonify({'ok': False, 'error': f'Error al registrar el lote: {e}'}), 500
+
+    # Una clave repetida dentro del lote es la misma venta: se reporta con el folio
+    # de la primera (o como error si la primera se rechazó)
+    folios = {r['clave']: r['id'] for r in resultado['insertadas'] + resultado['duplicadas']}
+    for i, clave in repetidas:
+        if clave in folios:
+            resultado['duplicadas'].append({'clave': clave, 'id': folios[clave], 'indice': i})
+        else:
+            errores.append({'indice': i, 'error': 'Clave repetida en el lote'})
+
+    if resultado['insertadas']:
+        _datos_cambiaron()
+        publicar_catalogo()
+        try:
+            export_historial_json()
+        except Exception as _e:
+            print('export warning:', _e)
+
+    return jsonify({'ok': True, 'errores': errores, **resultado})
+
 @app.route('/almacen')
 @login_required
 def almacen():
     codigo = request.args.get('codigo', '')
-    return render_template('almacen.html', codigo=codigo)
+    if codigo:
+        return render_template('almacen.html', codigo=codigo)
+    return pagina_fija('almacen.html', codigo='')
 
 @app.route('/guardar_producto', methods=['POST'])
 @login_required
@@ -446,14 +1136,69 @@ def guardar_producto():
         'stock': cantidad,
         'categoria': seccion,
     }
+    if 'proveedor' in data:
+        data_sql['proveedor_id'] = data.get('proveedor')
     _id = productos_guardar(data_sql)
 
+    publicar_catalogo()
+
+    return {'success': True, 'id': _id}
+
+# ===================== IMPORTACIÓN MASIVA (CSV) =====================
+@app.post('/importar_productos')
+@login_required
+def importar_productos():
+    """CSV con encabezado: codigo,nombre,precio,stock,categoria[,proveedor] (archivo 'archivo' o cuerpo text/csv)."""
+    archivo = request.files.get('archivo')
+    fuente = archivo.stream if archivo else request.stream
     try:
-        export_productos_json()
+        res = productos_importar_csv(fuente)
     except Exception as e:
-        print('export productos warning:', e)
+        return jsonify({'success': False, 'message': f'Error al importar: {e}'}), 400
 
-    return {'success': True, 'id': _id}
+    publicar_catalogo()
+
+    return jsonify({'success': True, **res})
+
+@app.cli.command('importar-productos')
+@click.argument('ruta', type=click.Path(exists=True, dir_okay=False))
+def importar_productos_cmd(ruta):
+    """Importa el catálogo desde un CSV (codigo,nombre,precio,stock,categoria[,proveedor])."""
+    g.tenant_schema = TENANT_SCHEMA
+    with open(ruta, 'rb') as f:
+        res = productos_importar_csv(f)
+    export_productos_json()
+    print('importar-productos:', ', '.join(f'{k}={v}' for k, v in res.items()))
+
+# ===================== AJUSTE MASIVO =====================
+@app.post('/api/productos/ajuste_masivo')
+@login_required
+def ajuste_masivo():
+    """
+    JSON: {categoria | ids, precio: {modo: porcentaje|monto, valor},
+           stock: {modo: fijar|sumar, valor}, simular: bool}
+    """
+    data = request.get_json() or {}
+    precio = data.get('precio') or {}
+    stock = data.get('stock') or {}
+    ids = [str(i).strip() for i in (data.get('ids') or []) if str(i).strip()]
+    try:
+        res = productos_ajuste_masivo(
+            categoria=data.get('categoria'),
+            ids=ids,
+            precio_modo=precio.get('modo'),
+            precio_valor=float(precio.get('valor') or 0),
+            stock_modo=stock.get('modo'),
+            stock_valor=int(stock.get('valor') or 0),
+            simular=bool(data.get('simular')),
+        )
+    except (ValueError, TypeError) as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    if not res['simulado'] and res['afectados']:
+        publicar_catalogo()
+
+    return jsonify({'success': True, **res})
 
 # ===================== BORRADO FORZADO =====================
 @app.route('/eliminar_producto', methods=['POST'])
@@ -464,30 +1209,18 @@ def eliminar_producto():
     if not codigo:
         return jsonify({'success': False, 'message': 'Falta el código.'}), 400
 
-    cur = None
     try:
-        with get_db() as conn:
-            conn.execute('BEGIN')
-            conn.execute('DELETE FROM venta_items WHERE producto_id = ?', (codigo,))
-            cur = conn.execute('DELETE FROM productos WHERE id = ?', (codigo,))
-            conn.execute('COMMIT')
-
-        if cur and cur.rowcount > 0:
-            try:
-                export_productos_json()
-            except Exception as e:
-                print('export productos warning:', e)
-            return jsonify({'success': True}), 200
-
-        return jsonify({'success': False, 'message': 'Producto no encontrado.'}), 404
-
+        # Baja lógica: el historial (tickets, reportes) no se toca
+        eliminado = productos_eliminar(codigo)
     except Exception as e:
-        try:
-            conn.execute('ROLLBACK')
-        except Exception:
-            pass
         return jsonify({'success': False, 'message': f'Error al eliminar: {e}'}), 500
 
+    if eliminado:
+        publicar_catalogo()
+        return jsonify({'success': True}), 200
+
+    return jsonify({'success': False, 'message': 'Producto no encontrado.'}), 404
+
 @app.route('/api/productos')
 def api_productos():
     incluir_manuales = (request.args.get('incluir_manuales') == '1')
@@ -506,36 +1239,75 @@ def api_productos():
         }
     return jsonify(salida)
 
+@app.get('/api/productos/buscar')
+@login_required
+def api_productos_buscar():
+    try:
+        pagina = int(request.args.get('pagina') or 1)
+        por_pagina = int(request.args.get('por_pagina') or 50)
+    except ValueError:
+        return jsonify({'error': 'Paginación inválida'}), 400
+    res = productos_buscar(
+        q=request.args.get('q') or '',
+        categoria=request.args.get('categoria') or '',
+        estado=request.args.get('estado') or '',
+        pagina=pagina,
+        por_pagina=por_pagina,
+        incluir_manuales=(request.args.get('incluir_manuales') == '1'),
+    )
+    res['productos'] = [{
+        'codigo': str(p['id']),
+        'nombre': p['nombre'],
+        'precio': float(p['precio'] or 0),
+        'cantidad': int(p['stock'] or 0),
+        'seccion': p['categoria'] or '',
+        'proveedor': p['proveedor_id'] or '',
+    } for p in res['productos']]
+    return jsonify(res)
+
+@app.get('/api/productos/por_ids')
+@login_required
+def api_productos_por_ids():
+    """?ids=a&ids=b -> productos activos (los que no vengan ya no existen o se dieron de baja)."""
+    return jsonify([{
+        'codigo': str(p['id']),
+        'nombre': p['nombre'],
+        'precio': float(p['precio'] or 0),
+        'cantidad': int(p['stock'] or 0),
+        'seccion': p['categoria'] or '',
+        'proveedor': p['proveedor_id'] or '',
+    } for p in productos_por_ids(request.args.getlist('ids')[:500])])
+
 @app.route('/api/historial')
+@respuesta_por_version
 def api_historial():
+    try:
+        conds, params = _filtro_fechas(*_rango_args())
+        archivadas = _archivadas(*_rango_args())
+    except ValueError:
+        return jsonify({'error': 'Fecha inválida'}), 400
+    ids = _ids_args()
+    if ids:
+        conds.append('id = ANY(?)')
+        params.append(ids)
+        archivadas = []
+    where = (' WHERE ' + ' AND '.join(conds)) if conds else ''
+
     items_salida = []
-    with get_db() as conn:
-        ventas = conn.execute(
-            'SELECT id, fecha, total, extra FROM ventas ORDER BY fecha ASC, id ASC'
-        ).fetchall()
+    with get_db(solo_lectura=not ids) as conn:
+        ventas = itertools.chain(archivadas, conn.execute(
+            f'SELECT {_VENTA_COLS} FROM ventas' + where + ' ORDER BY momento ASC, id ASC',
+            params
+        ).fetchall())
 
         for v in ventas:
-            fecha_txt = v['fecha'] or ''
-            if ' ' in fecha_txt:
-                fecha_str, hora_str = fecha_txt.split(' ', 1)
-            else:
-                fecha_str, hora_str = fecha_txt, ''
-
-            redondeo = 0.0
-            if v['extra']:
-                try:
-                    extra = json.loads(v['extra'])
-                    redondeo = float(extra.get('redondeo', 0))
-                    if not hora_str and extra.get('hora'):
-                        hora_str = str(extra['hora'])
-                except Exception:
-                    pass
+            fecha_str, hora_str, redondeo = _venta_campos(v)
 
-            det = conn.execute(
+            det = v['items'] if 'items' in v else conn.execute(
                 'SELECT vi.cantidad, COALESCE(p.nombre, vi.producto_id) AS nombre '
                 'FROM venta_items vi LEFT JOIN productos p ON p.id = vi.producto_id '
-                'WHERE vi.venta_id=?',
-                (v['id'],)
+                'WHERE ' + _items_de_venta(),
+                (v['id'], v['momento'])
             ).fetchall()
 
             resumen = {}
@@ -548,6 +1320,7 @@ def api_historial():
                     resumen[nom] = {'nombre': nom, 'cantidad': cant}
 
             items_salida.append({
+                'id': v['id'],
                 'fecha': fecha_str,
                 'hora': hora_str,
                 'total': float(v['total'] or 0),
@@ -560,33 +1333,52 @@ def api_historial():
 @app.route('/centavos')
 @login_required
 def centavos():
+    try:
+        conds, params = _filtro_fechas(*_rango_args())
+        archivadas = _archivadas(*_rango_args())
+    except ValueError:
+        return jsonify({'error': 'Fecha inválida'}), 400
+
+    if _tipadas['pendientes']:
+        # Filas sin respaldar: el redondeo sale del texto extra (índice idx_ventas_sin_tipar)
+        conds.append("(redondeo > 0 OR (redondeo IS NULL AND "
+                     "numero_o_nulo(json_o_vacio(extra)->>'redondeo') > 0))")
+        redondeo_sql = _REDONDEO_SQL
+    else:
+        conds.append('redondeo > 0')
+        redondeo_sql = 'redondeo'
+    where = ' WHERE ' + ' AND '.join(conds)
+
     centavos_list = []
     total_centavos = 0.0
-    with get_db() as conn:
+    for v in archivadas:
+        fecha_str, hora_str, redondeo = _venta_campos(v)
+        if redondeo > 0:
+            centavos_list.append({
+                'fecha': fecha_str,
+                'hora': hora_str,
+                'total': float(v['total'] or 0),
+                'redondeo': round(redondeo, 2)
+            })
+            total_centavos += redondeo
+
+    # Filtro y suma en SQL sobre la columna tipada (índice parcial redondeo > 0)
+    with get_db(solo_lectura=True) as conn:
         ventas = conn.execute(
-            'SELECT fecha, total, extra FROM ventas ORDER BY fecha ASC, id ASC'
+            f'SELECT momento, fecha, total, {redondeo_sql} AS redondeo FROM ventas' + where +
+            ' ORDER BY momento ASC, id ASC',
+            params
         ).fetchall()
-        for v in ventas:
-            redondeo = 0.0
-            fecha_txt = v['fecha'] or ''
-            if ' ' in fecha_txt:
-                fecha_str, hora_str = fecha_txt.split(' ', 1)
-            else:
-                fecha_str, hora_str = fecha_txt, ''
-            if v['extra']:
-                try:
-                    extra = json.loads(v['extra'])
-                    redondeo = float(extra.get('redondeo', 0))
-                except Exception:
-                    pass
-            if redondeo > 0:
-                centavos_list.append({
-                    'fecha': fecha_str,
-                    'hora': hora_str,
-                    'total': float(v['total'] or 0),
-                    'redondeo': round(redondeo, 2)
-                })
-                total_centavos += redondeo
+        suma = conn.execute(f'SELECT COALESCE(SUM({redondeo_sql}), 0) AS s FROM ventas' + where, params).fetchone()
+    total_centavos += float(suma['s'] or 0)
+    for v in ventas:
+        fecha_str, hora_str, redondeo = _venta_campos(v)
+        centavos_list.append({
+            'fecha': fecha_str,
+            'hora': hora_str,
+            'total': float(v['total'] or 0),
+            'redondeo': round(redondeo, 2)
+        })
 
     return render_template('centavos.html', centavos=centavos_list, total_centavos=round(total_centavos, 2))
 
@@ -611,12 +1403,12 @@ def carrito_eliminar():
 @app.route('/historial')
 @login_required
 def historial():
-    return render_template('historial.html')
+    return pagina_fija('historial.html')
 
 @app.route('/usuarios')
 @login_required
 def usuarios():
-    return render_template('usuarios.html')
+    return pagina_fija('usuarios.html')
 
 # ====== LOGIN/LOGOUT ======
 from urllib.parse import urlparse
@@ -666,7 +1458,7 @@ def logout():
 @app.route('/proveedores')
 @login_required
 def proveedores_view():
-    return render_template('proveedores.html')
+    return pagina_fija('proveedores.html')
 
 @app.route('/api/proveedores')
 @login_required
@@ -688,45 +1480,84 @@ def eliminar_proveedor():
     proveedores_eliminar(pid)
     return jsonify({'success': True})
 
-# ===================== Ruta de ticket =====================
-@app.route('/ticket/<vid>')
-def ticket(vid):
-    negocio = {
-        "nombre": "PilotoPOS",
-        "direccion": "Mi calle #123, Ciudad",
-        "telefono": "Tel. 000-000-0000"
-    }
+# ===================== REABASTO =====================
+@app.route('/reabasto')
+@login_required
+def reabasto_view():
+    return pagina_fija('reabasto.html')
 
+@app.route('/api/reabasto')
+@login_required
+def api_reabasto():
+    """Lista de pedido por proveedor (?proveedor=<id>, ?dias=<cobertura>)."""
+    proveedor = request.args.get('proveedor')
+    dias = max(1, min(request.args.get('dias', 14, type=int), 180))
+    productos = reabasto_sugerido(proveedor, dias)
+
+    grupos = {}
+    for p in productos:
+        grupo = grupos.setdefault(p['proveedor_id'], {
+            'id': p['proveedor_id'],
+            'nombre': p['proveedor'] or 'Sin proveedor',
+            'productos': [],
+        })
+        grupo['productos'].append(p)
+    # El proveedor más urgente primero (los productos ya vienen ordenados)
+    return jsonify({'dias': dias, 'proveedores': list(grupos.values())})
+
+@app.cli.command('reconstruir-velocidad')
+@click.option('--dias', default=90, show_default=True, help='Días de ventas a considerar.')
+def reconstruir_velocidad_cmd(dias):
+    """Siembra la velocidad de venta desde el historial reciente (una sola vez)."""
+    g.tenant_schema = TENANT_SCHEMA
+    print(f'reconstruir-velocidad: {velocidad_reconstruir(dias)} producto(s)')
+
+# ===================== Ruta de ticket =====================
+NEGOCIO = {
+    "nombre": "PilotoPOS",
+    "direccion": "Mi calle #123, Ciudad",
+    "telefono": "Tel. 000-000-0000"
+}
+
+# Una venta cerrada no cambia salvo por /ventas/update o /ventas/delete,
+# así que el ticket se renderiza una vez y se guarda en memoria y en disco.
+TICKETS_DIR = os.path.join(DATA_DIR, 'tickets')
+os.makedirs(TICKETS_DIR, exist_ok=True)
+TICKET_COLUMNAS = int(os.getenv("TICKET_COLUMNAS", "32"))  # 32 = papel de 58 mm
+_VID_SEGURO = re.compile(r'^[A-Za-z0-9_-]+$')
+
+def _ticket_folio(vid):
+    """Folio canónico (numérico) del ticket; los folios de texto anteriores se traducen."""
+    if vid.isdigit() or _folios_texto():
+        return vid
     with get_db() as conn:
-        v = conn.execute(
-            "SELECT id, fecha, total, extra FROM ventas WHERE id=?",
-            (vid,)
-        ).fetchone()
-        if not v:
-            return "Ticket no encontrado", 404
+        return str(folio_resolver(conn, vid))
 
-        items = conn.execute(
-            "SELECT COALESCE(p.nombre, vi.producto_id) AS nombre, vi.cantidad, vi.precio_unitario "
-            "FROM venta_items vi LEFT JOIN productos p ON p.id = vi.producto_id "
-            "WHERE vi.venta_id=? ORDER BY vi.id",
-            (vid,)
-        ).fetchall()
+def _ticket_datos(vid):
+    v = None
+    with get_db() as conn:
+        venta_id = _venta_id(vid, conn)
+        if venta_id is not None:
+            v = conn.execute(
+                f"SELECT {_VENTA_COLS} FROM ventas WHERE id=?",
+                (venta_id,)
+            ).fetchone()
+            if v:
+                items = conn.execute(
+                    "SELECT COALESCE(p.nombre, vi.producto_id) AS nombre, vi.cantidad, vi.precio_unitario "
+                    "FROM venta_items vi LEFT JOIN productos p ON p.id = vi.producto_id "
+                    "WHERE vi.venta_id=? ORDER BY vi.id",
+                    (venta_id,)
+                ).fetchall()
 
-    redondeo = 0.0
-    hora_str = ""
-    if v["extra"]:
-        try:
-            extra = json.loads(v["extra"])
-            redondeo = float(extra.get("redondeo", 0))
-            hora_str = extra.get("hora") or ""
-        except Exception:
-            pass
+    if not v:
+        # Ventas viejas movidas a los segmentos de archivo
+        v = venta_archivada(DATA_DIR, int(vid) if vid.isdigit() else vid)
+        if not v:
+            return None
+        items = v['items']
 
-    fecha_txt = v["fecha"] or ""
-    if " " in fecha_txt and not hora_str:
-        fecha_str, hora_str = fecha_txt.split(" ", 1)
-    else:
-        fecha_str = fecha_txt or ""
+    fecha_str, hora_str, redondeo = _venta_campos(v)
 
     lineas = []
     subtotal = 0.0
@@ -745,76 +1576,172 @@ def ticket(vid):
 
     total = float(v["total"] or 0)
 
-    return render_template(
-        "ticket.html",
-        negocio=negocio,
+    return dict(
+        negocio=NEGOCIO,
         venta=dict(id=v["id"], fecha=fecha_str, hora=hora_str, total=total),
         lineas=lineas,
         redondeo=redondeo,
         subtotal=subtotal
     )
 
+def _ticket_texto(d):
+    """Ticket en texto plano a TICKET_COLUMNAS columnas (impresoras térmicas)."""
+    ancho = TICKET_COLUMNAS
+
+    def par(izq, der):
+        izq = izq[:max(0, ancho - len(der) - 1)]
+        return izq + " " * (ancho - len(izq) - len(der)) + der
+
+    v = d["venta"]
+    out = [d["negocio"]["nombre"].center(ancho)]
+    for k in ("direccion", "telefono"):
+        if d["negocio"].get(k):
+            out.append(d["negocio"][k][:ancho].center(ancho))
+    out += ["-" * ancho, f"Folio #{v['id']}"[:ancho], f"Fecha: {v['fecha']} {v['hora']}".rstrip()[:ancho], "-" * ancho]
+    for it in d["lineas"]:
+        out.append(par(f"{it['cantidad']}x {it['nombre']}", f"${it['importe']:.2f}"))
+        out.append(f"   @ ${it['pu']:.2f}")
+    out.append("-" * ancho)
+    out.append(par("Subtotal", f"${d['subtotal']:.2f}"))
+    if d["redondeo"]:
+        out.append(par("Redondeo", f"${d['redondeo']:.2f}"))
+    out.append(par("TOTAL", f"${v['total']:.2f}"))
+    out += ["-" * ancho, "¡Gracias por su compra!".center(ancho), ""]
+    return "\n".join(out)
+
+def _ticket_preparar(vid):
+    """
+    Renderiza HTML y texto del ticket y los guarda en disco y en el caché de
+    respuestas (LRU acotado, por versión de datos: una edición en cualquier
+    worker lo invalida). Regresa {'html': (bytes, etag), 'txt': (bytes, etag)}.
+    """
+    vid = _ticket_folio(vid)
+    seguro = bool(_VID_SEGURO.match(vid))
+    base = os.path.join(TICKETS_DIR, vid)
+    claves = {ext: _respuestas.clave(g.tenant_schema, 'ticket' + ext, {'vid': vid}) for ext in ('.html', '.txt')}
+    entrada = {ext[1:]: _respuestas.obtener(c) for ext, c in claves.items()}
+    # El archivo en disco es la señal compartida entre workers: si otro lo invalidó, se re-renderiza
+    if all(entrada.values()) and (not seguro or os.path.exists(base + '.html')):
+        return entrada
+    if seguro and os.path.exists(base + '.html') and os.path.exists(base + '.txt'):
+        with open(base + '.html', 'rb') as f:
+            html = f.read()
+        with open(base + '.txt', 'rb') as f:
+            txt = f.read()
+    else:
+        d = _ticket_datos(vid)
+        if d is None:
+            return None
+        html = render_template("ticket.html", **d).encode('utf-8')
+        txt = _ticket_texto(d).encode('utf-8')
+        if seguro:
+            for ext, contenido in (('.html', html), ('.txt', txt)):
+                tmp = f"{base}{ext}.tmp"
+                with open(tmp, 'wb') as f:
+                    f.write(contenido)
+                os.replace(tmp, base + ext)
+
+    return {
+        'html': _respuestas.guardar(claves['.html'], html),
+        'txt': _respuestas.guardar(claves['.txt'], txt),
+    }
+
+def _ticket_invalidar(vid):
+    # La copia en memoria cae con _datos_cambiaron(); aquí solo la de disco
+    if _VID_SEGURO.match(vid):
+        for ext in ('.html', '.txt'):
+            try:
+                os.remove(os.path.join(TICKETS_DIR, vid + ext))
+            except FileNotFoundError:
+                pass
+
+def _ticket_respuesta(cuerpo, etag, mimetype):
+    resp = make_response(cuerpo)
+    resp.mimetype = mimetype
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp.make_conditional(request)
+
+@app.route('/ticket/<vid>')
+def ticket(vid):
+    t = _ticket_preparar(vid)
+    if not t:
+        return "Ticket no encontrado", 404
+    return _ticket_respuesta(*t['html'], 'text/html')
+
+@app.route('/ticket/<vid>/texto')
+def ticket_texto(vid):
+    """Texto plano; con ?formato=escpos se envuelve en comandos ESC/POS."""
+    t = _ticket_preparar(vid)
+    if not t:
+        return "Ticket no encontrado", 404
+    if request.args.get('formato') == 'escpos':
+        # ESC @ (inicializar), ESC t 2 (página CP850), texto, avance y corte parcial (GS V 66 0)
+        txt, etag = t['txt']
+        cuerpo = (b'\x1b@\x1bt\x02' + txt.decode('utf-8').encode('cp850', 'replace')
+                  + b'\n\n\n\x1dVB\x00')
+        return _ticket_respuesta(cuerpo, etag + '-escpos', 'application/octet-stream')
+    return _ticket_respuesta(*t['txt'], 'text/plain')
+
 # ===================== PANEL DE DATOS (ADMIN) =====================
 @app.route('/panel')
 @login_required
 def panel():
-    return render_template('admin_datos.html')
+    return pagina_fija('admin_datos.html')
 
 @app.get('/api/ventas')
 @login_required
+@respuesta_por_version
 def api_ventas():
     q = (request.args.get('q') or '').strip()
     desde = (request.args.get('desde') or '').strip()
     hasta = (request.args.get('hasta') or '').strip()
 
-    sql = "SELECT id, fecha, total, extra FROM ventas"
-    conds = []
-    params = []
+    sql = f"SELECT {_VENTA_COLS} FROM ventas"
+    try:
+        conds, params = _filtro_fechas(desde, hasta)
+        archivadas = _archivadas(desde, hasta, recientes_primero=True)
+    except ValueError:
+        return jsonify({"ok": False, "msg": "Fecha inválida"}), 400
+    if q:
+        archivadas = (a for a in archivadas if q in str(a['id']) or q in (a['fecha'] or ''))
 
     if q:
-        conds.append("(id LIKE ? OR fecha LIKE ?)")
+        conds.append("(id::text LIKE ? OR fecha LIKE ?)")
         params.extend([f"%{q}%", f"%{q}%"])
-    if desde:
-        conds.append("substr(fecha,1,10) >= ?")
-        params.append(desde)
-    if hasta:
-        conds.append("substr(fecha,1,10) <= ?")
-        params.append(hasta)
+
+    ids = _ids_args()
+    if ids:
+        conds.append("id = ANY(?)")
+        params.append(ids)
+        archivadas = []
 
     if conds:
         sql += " WHERE " + " AND ".join(conds)
 
-    sql += " ORDER BY fecha DESC, id DESC"
+    sql += " ORDER BY momento DESC, id DESC"
 
     salida = []
-    with get_db() as conn:
-        ventas = conn.execute(sql, params).fetchall()
+    with get_db(solo_lectura=not ids) as conn:
+        ventas = itertools.chain(conn.execute(sql, params).fetchall(), archivadas)
         for v in ventas:
             vid = v['id']
-            fecha_txt = v['fecha'] or ""
-            if " " in fecha_txt:
-                fecha_str, hora_str = fecha_txt.split(" ", 1)
-            else:
-                fecha_str, hora_str = fecha_txt, ""
-
-            redondeo = 0.0
-            if v['extra']:
-                try:
-                    extra = json.loads(v['extra'])
-                    redondeo = float(extra.get('redondeo', 0))
-                    if not hora_str and extra.get('hora'):
-                        hora_str = str(extra['hora'])
-                except Exception:
-                    pass
+            fecha_str, hora_str, redondeo = _venta_campos(v)
 
-            det = conn.execute(
-                "SELECT COALESCE(p.nombre, vi.producto_id) AS nombre, SUM(vi.cantidad) AS cant "
-                "FROM venta_items vi LEFT JOIN productos p ON p.id = vi.producto_id "
-                "WHERE vi.venta_id=? "
-                "GROUP BY COALESCE(p.nombre, vi.producto_id) "
-                "ORDER BY nombre",
-                (vid,)
-            ).fetchall()
+            if 'items' in v:
+                cants = {}
+                for it in v['items']:
+                    cants[it['nombre']] = cants.get(it['nombre'], 0) + it['cantidad']
+                det = [{'nombre': k, 'cant': cants[k]} for k in sorted(cants)]
+            else:
+                det = conn.execute(
+                    "SELECT COALESCE(p.nombre, vi.producto_id) AS nombre, SUM(vi.cantidad) AS cant "
+                    "FROM venta_items vi LEFT JOIN productos p ON p.id = vi.producto_id "
+                    "WHERE " + _items_de_venta() + " "
+                    "GROUP BY COALESCE(p.nombre, vi.producto_id) "
+                    "ORDER BY nombre",
+                    (vid, v['momento'])
+                ).fetchall()
             productos_txt = ", ".join([f"{int(d['cant'] or 0)}x {d['nombre']}" for d in det]) if det else ""
 
             salida.append({
@@ -828,12 +1755,108 @@ def api_ventas():
 
     return jsonify(salida)
 
-app.post('/ventas/update')
+@app.get('/api/ventas/exportar')
+@login_required
+def api_ventas_exportar():
+    """
+    CSV en streaming para contabilidad: ?nivel=ventas|items&desde=&hasta=&zstd=1
+    Memoria constante: los bloques de COPY van directo a la respuesta.
+    """
+    nivel = request.args.get('nivel') or 'ventas'
+    desde, hasta = _rango_args()
+    try:
+        ini, fin = _rango_fechas(desde, hasta)
+    except ValueError:
+        return jsonify({"ok": False, "msg": "Fecha inválida"}), 400
+    if nivel not in ('ventas', 'items'):
+        return jsonify({"ok": False, "msg": "nivel debe ser 'ventas' o 'items'"}), 400
+
+    comprimir = request.args.get('zstd') == '1'
+    cuerpo = ventas_exportar_csv(nivel, LOCAL_TZ.key, ini, fin)
+    if comprimir:
+        cuerpo = _zstd_stream(cuerpo)
+
+    nombre = f"ventas_{nivel}_{desde or 'inicio'}_{hasta or 'hoy'}.csv" + ('.zst' if comprimir else '')
+    return Response(
+        stream_with_context(cuerpo),
+        mimetype='application/zstd' if comprimir else 'text/csv',
+        headers={'Content-Disposition': f'attachment; filename="{nombre}"'},
+    )
+
+def _zstd_stream(bloques, nivel=6):
+    c = pyzstd.ZstdCompressor(nivel)
+    for b in bloques:
+        out = c.compress(b)
+        if out:
+            yield out
+    yield c.flush()
+
+@app.cli.command('exportar-ventas')
+@click.argument('salida', type=click.Path(dir_okay=False, writable=True))
+@click.option('--nivel', type=click.Choice(['ventas', 'items']), default='ventas')
+@click.option('--desde', default='')
+@click.option('--hasta', default='')
+@click.option('--zstd', 'comprimir', is_flag=True, help='Comprime la salida con zstd')
+def exportar_ventas_cmd(salida, nivel, desde, hasta, comprimir):
+    """Escribe el CSV de ventas (o renglones) a SALIDA sin cargarlo en memoria."""
+    g.tenant_schema = TENANT_SCHEMA
+    ini, fin = _rango_fechas(desde, hasta)
+    bloques = ventas_exportar_csv(nivel, LOCAL_TZ.key, ini, fin)
+    if comprimir:
+        bloques = _zstd_stream(bloques)
+    with open(salida, 'wb') as f:
+        for b in bloques:
+            f.write(b)
+    print(f'exportar-ventas: {salida}')
+
+# ===================== ANALÍTICA =====================
+ANALITICA_CACHE_SEG = int(os.getenv("ANALITICA_CACHE_SEG", "300"))
+_analitica_cache = {}  # (desde, hasta, versión) -> (momento, json en bytes)
+
+@app.get('/api/analitica')
+@login_required
+def api_analitica():
+    """
+    Indicadores del rango (?desde=&hasta=, por omisión los últimos 30 días):
+    top de productos, mapa hora × día, canasta, redondeo aceptado y pares.
+    """
+    hoy = datetime.now(LOCAL_TZ).date()
+    desde = request.args.get('desde') or (hoy - timedelta(days=29)).isoformat()
+    hasta = request.args.get('hasta') or hoy.isoformat()
+    try:
+        ini, fin = _rango_fechas(desde, hasta)
+    except ValueError:
+        return jsonify({'error': 'Fecha inválida'}), 400
+
+    # Con la versión de datos en la clave, una venta nueva no espera al TTL
+    clave = (desde, hasta, _respuestas.version(g.tenant_schema))
+    guardado = _analitica_cache.get(clave)
+    if not guardado or time.time() - guardado[0] > ANALITICA_CACHE_SEG:
+        res = analitica_calcular(*analitica_cargar(ini, fin, LOCAL_TZ.key, _folios_texto()))
+        res.update({'desde': desde, 'hasta': hasta})
+        guardado = (time.time(), json.dumps(res, ensure_ascii=False).encode('utf-8'))
+        if len(_analitica_cache) >= 32:
+            _analitica_cache.pop(min(_analitica_cache, key=lambda k: _analitica_cache[k][0]))
+        _analitica_cache[clave] = guardado
+
+    resp = make_response(guardado[1])
+    resp.mimetype = 'application/json'
+    resp.headers['Cache-Control'] = f'private, max-age={ANALITICA_CACHE_SEG}'
+    return resp
+
+@app.cli.command('analitica-medir')
+@click.option('--renglones', default=2_000_000, show_default=True, help='Renglones sintéticos.')
+def analitica_medir_cmd(renglones):
+    """Mide el cálculo vectorizado sobre datos sintéticos (sin base de datos)."""
+    analitica_medir(renglones)
+
+@app.post('/ventas/update')
 @login_required
 def ventas_update():
     data = request.get_json(silent=True) or {}
-    vid = (data.get('id') or '').strip()
-    if not vid:
+    vid = str(data.get('id') or '').strip()
+    venta_id = _venta_id(vid)
+    if venta_id is None:
         return jsonify({"ok": False, "msg": "Falta id"}), 400
 
     nueva_fecha = (data.get('fecha') or '').strip()
@@ -849,36 +1872,38 @@ def ventas_update():
         return jsonify({"ok": False, "msg": "Redondeo inválido"}), 400
 
     with get_db() as conn:
-        v = conn.execute("SELECT fecha, extra FROM ventas WHERE id=?", (vid,)).fetchone()
+        v = conn.execute(
+            "SELECT momento, fecha, COALESCE(extra_jsonb, json_o_vacio(extra)) AS extra FROM ventas WHERE id=?",
+            (venta_id,)
+        ).fetchone()
         if not v:
             return jsonify({"ok": False, "msg": "Venta no encontrada"}), 404
 
-        fecha_actual = v['fecha'] or ""
-        if " " in fecha_actual:
-            f_exist, h_exist = fecha_actual.split(" ", 1)
-        else:
-            f_exist, h_exist = fecha_actual, ""
-
+        f_exist, h_exist, _ = _venta_campos(v)
         f_final = nueva_fecha if nueva_fecha else f_exist
         h_final = nueva_hora if nueva_hora else h_exist
-        fecha_hora = f_final.strip()
-        if h_final:
-            fecha_hora = f"{f_final.strip()} {h_final.strip()}"
+        fecha_hora = f"{f_final.strip()} {h_final.strip()}"
 
-        extra = {}
-        if v['extra']:
-            try:
-                extra = json.loads(v['extra'])
-            except Exception:
-                extra = {}
+        try:
+            momento = datetime.fromisoformat(fecha_hora).replace(tzinfo=LOCAL_TZ)
+        except ValueError:
+            return jsonify({"ok": False, "msg": "Fecha inválida"}), 400
+
+        extra = dict(v['extra'] or {})
         extra['redondeo'] = float(nuevo_redondeo)
-        if h_final:
-            extra['hora'] = h_final
+        extra['hora'] = h_final
 
+        # Si cambia de mes, la venta (y sus ítems, por la FK en cascada) pasa a otra partición
+        conn.execute(
+            "UPDATE ventas SET momento=?, fecha=?, total=?, redondeo=?, extra_jsonb=?::jsonb, extra=NULL WHERE id=?",
+            (momento, fecha_hora, float(nuevo_total), float(nuevo_redondeo), json.dumps(extra, ensure_ascii=False), venta_id)
+        )
         conn.execute(
-            "UPDATE ventas SET fecha=?, total=?, extra=? WHERE id=?",
-            (fecha_hora, float(nuevo_total), json.dumps(extra, ensure_ascii=False), vid)
+            "UPDATE venta_items SET venta_momento=? WHERE venta_id=? AND venta_momento IS DISTINCT FROM ?",
+            (momento, venta_id, momento)
         )
+    _ticket_invalidar(vid)
+    _datos_cambiaron()
 
     return jsonify({"ok": True})
 
@@ -886,17 +1911,20 @@ def ventas_update():
 @login_required
 def ventas_delete():
     data = request.get_json(silent=True) or {}
-    vid = (data.get('id') or '').strip()
-    if not vid:
+    vid = str(data.get('id') or '').strip()
+    venta_id = _venta_id(vid)
+    if venta_id is None:
         return jsonify({"ok": False, "msg": "Falta id"}), 400
 
     with get_db() as conn:
-        v = conn.execute("SELECT id FROM ventas WHERE id=?", (vid,)).fetchone()
+        v = conn.execute("SELECT id FROM ventas WHERE id=?", (venta_id,)).fetchone()
         if not v:
             return jsonify({"ok": False, "msg": "Venta no encontrada"}), 404
 
-        conn.execute("DELETE FROM venta_items WHERE venta_id=?", (vid,))
-        conn.execute("DELETE FROM ventas WHERE id=?", (vid,))
+        conn.execute("DELETE FROM venta_items WHERE venta_id=?", (venta_id,))
+        conn.execute("DELETE FROM ventas WHERE id=?", (venta_id,))
+    _ticket_invalidar(vid)
+    _datos_cambiaron()
 
     return jsonify({"ok": True})
 # ===== PROBE DE DIAGNÓSTICO =====
@@ -0,0 +1,242 @@
+# archivo.py — ventas antiguas en segmentos NDJSON comprimidos con zstd
+#
+# Cada segmento guarda las ventas de un mes (una por línea, con sus ítems y el
+# nombre del producto al momento de archivar). indice.json lista los segmentos
+# con su rango de fechas (y de folios) para leer solo los que se cruzan con lo
+# pedido; <segmento>.ids.json guarda sus folios para buscar un ticket sin
+# descomprimir nada cuando el folio no está.
+import io
+import json
+import os
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Union
+
+import pyzstd
+
+from db import get_db
+
+NIVEL_ZSTD = 19
+
+def _dir(data_dir: str) -> str:
+    d = os.path.join(data_dir, "archivo")
+    os.makedirs(d, exist_ok=True)
+    return d
+
+def _leer_indice(data_dir: str) -> List[Dict]:
+    ruta = os.path.join(_dir(data_dir), "indice.json")
+    if not os.path.exists(ruta):
+        return []
+    with open(ruta, "r", encoding="utf-8") as f:
+        return json.load(f).get("segmentos", [])
+
+def _escribir_indice(data_dir: str, segmentos: List[Dict]) -> None:
+    ruta = os.path.join(_dir(data_dir), "indice.json")
+    tmp = ruta + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"segmentos": segmentos}, f, ensure_ascii=False)
+    os.replace(tmp, ruta)
+
+def _escribir_ids(data_dir: str, archivo: str, ids: List) -> None:
+    ruta = os.path.join(_dir(data_dir), archivo + ".ids.json")
+    tmp = f"{ruta}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(ids, f, ensure_ascii=False)
+    os.replace(tmp, ruta)
+
+# archivo -> set de folios (los segmentos no cambian una vez escritos)
+_ids_cache: Dict[str, set] = {}
+
+def _ids_segmento(data_dir: str, archivo: str) -> Optional[set]:
+    if archivo not in _ids_cache:
+        try:
+            with open(os.path.join(_dir(data_dir), archivo + ".ids.json"), "r", encoding="utf-8") as f:
+                _ids_cache[archivo] = set(json.load(f))
+        except FileNotFoundError:
+            return None
+    return _ids_cache[archivo]
+
+def _rango_ids(segmento: Dict, ids: List) -> None:
+    if ids and all(isinstance(i, int) for i in ids):
+        # Rango de folios: venta_archivada salta los segmentos que no lo contienen
+        segmento["id_min"], segmento["id_max"] = min(ids), max(ids)
+
+def _leer_segmento(data_dir: str, archivo: str) -> Iterator[Dict]:
+    with pyzstd.ZstdFile(os.path.join(_dir(data_dir), archivo), "rb") as zf:
+        for linea in io.TextIOWrapper(zf, encoding="utf-8"):
+            v = json.loads(linea)
+            v["momento"] = datetime.fromisoformat(v["momento"])
+            yield v
+
+def indexar(data_dir: str, log=print) -> int:
+    """
+    Crea el .ids.json (y el rango de folios) de los segmentos archivados antes
+    de que existieran. Se descomprime cada segmento una sola vez. Regresa
+    cuántos segmentos indexó.
+    """
+    segmentos = _leer_indice(data_dir)
+    n = 0
+    for s in segmentos:
+        if os.path.exists(os.path.join(_dir(data_dir), s["archivo"] + ".ids.json")):
+            continue
+        ids = [v["id"] for v in _leer_segmento(data_dir, s["archivo"])]
+        _escribir_ids(data_dir, s["archivo"], ids)
+        _rango_ids(s, ids)
+        n += 1
+    if n:
+        # Releer: otro proceso pudo agregar segmentos mientras tanto
+        rangos = {s["archivo"]: s for s in segmentos}
+        _escribir_indice(data_dir, [{**s, **rangos.get(s["archivo"], {})} for s in _leer_indice(data_dir)])
+        log(f"archivo: {n} segmento(s) indexados")
+    return n
+
+def _mes_siguiente(d: datetime) -> datetime:
+    return d.replace(year=d.year + 1, month=1) if d.month == 12 else d.replace(month=d.month + 1)
+
+def archivar(data_dir: str, antes_de: datetime, log=print) -> int:
+    """
+    Mueve las ventas con momento < antes_de a segmentos comprimidos, un mes a la vez.
+    Cada mes se escribe a disco y se registra en el índice antes de borrarse de la base.
+    Regresa cuántas ventas se archivaron.
+    """
+    with get_db() as conn:
+        row = conn.execute(
+            "SELECT min(momento) AS m FROM ventas WHERE momento < ?", (antes_de,)
+        ).fetchone()
+    if not row or row["m"] is None:
+        return 0
+
+    tz = antes_de.tzinfo
+    mes = row["m"].astimezone(tz).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    total = 0
+    while mes < antes_de:
+        fin = min(_mes_siguiente(mes), antes_de)
+        total += _archivar_rango(data_dir, mes, fin, log)
+        mes = _mes_siguiente(mes)
+    return total
+
+def _archivar_rango(data_dir: str, desde: datetime, hasta: datetime, log) -> int:
+    with get_db() as conn:
+        ventas = conn.execute(
+            "SELECT id, momento, fecha, cliente, total, "
+            "COALESCE(redondeo, numero_o_nulo(json_o_vacio(extra)->>'redondeo'), 0) AS redondeo, "
+            "COALESCE(extra_jsonb, json_o_vacio(extra)) AS extra FROM ventas "
+            "WHERE momento >= ? AND momento < ? ORDER BY momento, id",
+            (desde, hasta),
+        ).fetchall()
+        if not ventas:
+            return 0
+        items = conn.execute(
+            "SELECT vi.venta_id, vi.producto_id, COALESCE(p.nombre, vi.producto_id) AS nombre, "
+            "vi.cantidad, vi.precio_unitario "
+            "FROM venta_items vi LEFT JOIN productos p ON p.id = vi.producto_id "
+            "WHERE vi.venta_momento >= ? AND vi.venta_momento < ? ORDER BY vi.id",
+            (desde, hasta),
+        ).fetchall()
+
+    por_venta: Dict[str, List[Dict]] = {}
+    for it in items:
+        por_venta.setdefault(it["venta_id"], []).append({
+            "producto_id": it["producto_id"],
+            "nombre": it["nombre"],
+            "cantidad": int(it["cantidad"] or 0),
+            "precio_unitario": float(it["precio_unitario"] or 0),
+        })
+
+    segmentos = _leer_indice(data_dir)
+    base = f"ventas_{desde:%Y_%m}"
+    n = sum(1 for s in segmentos if s["archivo"].startswith(base))
+    nombre = f"{base}_{n:03d}.ndjson.zst"
+    ruta = os.path.join(_dir(data_dir), nombre)
+    with pyzstd.ZstdFile(ruta + ".tmp", "wb", level_or_option=NIVEL_ZSTD) as zf:
+        with io.TextIOWrapper(zf, encoding="utf-8") as f:
+            for v in ventas:
+                f.write(json.dumps({
+                    "id": v["id"],
+                    "momento": v["momento"].isoformat(),
+                    "fecha": v["fecha"],
+                    "cliente": v["cliente"],
+                    "total": float(v["total"] or 0),
+                    "redondeo": float(v["redondeo"] or 0),
+                    "extra": v["extra"],
+                    "items": por_venta.get(v["id"], []),
+                }, ensure_ascii=False) + "\n")
+    os.replace(ruta + ".tmp", ruta)
+
+    ids = [v["id"] for v in ventas]
+    _escribir_ids(data_dir, nombre, ids)
+    segmento = {
+        "archivo": nombre,
+        "desde": ventas[0]["momento"].isoformat(),
+        "hasta": ventas[-1]["momento"].isoformat(),
+        "ventas": len(ventas),
+    }
+    _rango_ids(segmento, ids)
+    segmentos.append(segmento)
+    _escribir_indice(data_dir, segmentos)
+
+    try:
+        with get_db() as conn:
+            # Los ítems se van con la FK en cascada
+            conn.execute(
+                "DELETE FROM ventas WHERE momento >= ? AND momento < ? AND id = ANY(?)",
+                (desde, hasta, ids),
+            )
+    except Exception:
+        # Sin borrar en la base el segmento duplicaría ventas: se retira del índice
+        _escribir_indice(data_dir, [s for s in segmentos if s["archivo"] != nombre])
+        os.remove(ruta)
+        os.remove(os.path.join(_dir(data_dir), nombre + ".ids.json"))
+        raise
+    log(f"archivar: {nombre} ({len(ventas)} ventas)")
+    return len(ventas)
+
+def hay_archivo(data_dir: str, desde: Optional[datetime] = None) -> bool:
+    """True si algún segmento puede tener ventas a partir de `desde`."""
+    segmentos = _leer_indice(data_dir)
+    if desde is None:
+        return bool(segmentos)
+    return any(datetime.fromisoformat(s["hasta"]) >= desde for s in segmentos)
+
+def ventas_archivadas(data_dir: str, desde: Optional[datetime] = None,
+                      hasta: Optional[datetime] = None, recientes_primero: bool = False) -> Iterator[Dict]:
+    """
+    Itera las ventas archivadas con desde <= momento < hasta, en orden
+    cronológico (o inverso). Solo descomprime los segmentos cuyo rango se
+    cruza con el pedido y de uno en uno: nunca tiene todo el archivo en memoria.
+    """
+    segmentos = sorted(_leer_indice(data_dir), key=lambda s: s["desde"], reverse=recientes_primero)
+    for s in segmentos:
+        if desde and datetime.fromisoformat(s["hasta"]) < desde:
+            continue
+        if hasta and datetime.fromisoformat(s["desde"]) >= hasta:
+            continue
+        ventas = (v for v in _leer_segmento(data_dir, s["archivo"])
+                  if not (desde and v["momento"] < desde) and not (hasta and v["momento"] >= hasta))
+        # Un segmento es un mes: para el orden inverso basta con tener ese mes en memoria
+        yield from (reversed(list(ventas)) if recientes_primero else ventas)
+
+def venta_archivada(data_dir: str, vid: Union[int, str]) -> Optional[Dict]:
+    """
+    Busca una venta archivada por id (para reimprimir tickets viejos). Solo
+    descomprime un segmento cuyo .ids.json tiene el folio; si ninguno lo
+    tiene regresa None sin leer segmentos (la ruta del ticket es pública).
+    """
+    segmentos = _leer_indice(data_dir)
+    if isinstance(vid, int):
+        segmentos = [s for s in segmentos if s.get("id_min", vid) <= vid <= s.get("id_max", vid)]
+    else:
+        # Los folios de texto V%Y%m%d... dicen en qué mes buscar
+        try:
+            mes = datetime.strptime(vid[1:7], "%Y%m").strftime("ventas_%Y_%m")
+        except ValueError:
+            return None
+        segmentos = [s for s in segmentos if s["archivo"].startswith(mes)]
+    for s in segmentos:
+        ids = _ids_segmento(data_dir, s["archivo"])
+        if ids is None or vid not in ids:
+            # Sin .ids.json (pendiente de indexar()) no se busca a ciegas
+            continue
+        for v in _leer_segmento(data_dir, s["archivo"]):
+            if v["id"] == vid:
+                return v
+    return None
@@ -0,0 +1,75 @@
+# cambios.py — avisos de cambios (LISTEN/NOTIFY) para los paneles de admin
+#
+# Triggers por sentencia (no por fila) avisan qué ids de productos / ventas
+# cambiaron; una importación de miles de filas es un solo aviso. Cada proceso
+# escucha con una sola conexión y reenvía los avisos al cuarto "admin".
+import json
+
+import psycopg
+
+CANAL = "pos_cambios"
+# Más ids que esto no caben cómodos en un NOTIFY (8000 bytes): el aviso va
+# sin ids y el cliente recarga lo que está viendo.
+MAX_IDS = 200
+
+def canal(schema: str) -> str:
+    return f"{CANAL}_{schema}"
+
+def _trigger(tabla: str, evento: str, aviso: str, columna: str, op: str = None) -> str:
+    transicion = "old table as viejas" if evento == "delete" else "new table as nuevas"
+    args = f"'{aviso}', '{columna}'" + (f", '{op}'" if op else "")
+    return (
+        f"create or replace trigger trg_{tabla}_aviso_{evento} after {evento} on {tabla} "
+        f"referencing {transicion} for each statement execute function notificar_cambios({args});\n"
+    )
+
+def ddl_avisos_ventas() -> str:
+    # Aparte: la migración a particiones tiene que volver a crearlos en la tabla nueva
+    return "".join(_trigger("ventas", ev, "ventas", "id") for ev in ("insert", "update", "delete"))
+
+def ddl_avisos() -> str:
+    return f'''
+    create or replace function notificar_cambios() returns trigger language plpgsql as $$
+    declare
+      ids jsonb;
+    begin
+      -- El compactador de inventario no cambia el stock visible: no avisa
+      if current_setting('pos.sin_avisos', true) = 'on' then
+        return null;
+      end if;
+      execute format('select jsonb_agg(id) from (select distinct %I as id from %I limit {MAX_IDS + 1}) t',
+                     tg_argv[1], case when tg_op = 'DELETE' then 'viejas' else 'nuevas' end)
+        into ids;
+      if ids is null then
+        return null;
+      end if;
+      perform pg_notify('{CANAL}_' || tg_table_schema, json_build_object(
+        'tabla', tg_argv[0],
+        'op', coalesce(tg_argv[2], lower(tg_op)),
+        'ids', case when jsonb_array_length(ids) > {MAX_IDS} then null else ids end
+      )::text);
+      return null;
+    end $$;
+    ''' + "".join(
+        _trigger("productos", ev, "productos", "id") for ev in ("insert", "update", "delete")
+    ) + _trigger(
+        # El stock cambia por movimientos, no por UPDATE a productos
+        "inventario_movimientos", "insert", "productos", "producto_id", "update"
+    ) + ddl_avisos_ventas()
+
+def escuchar(database_url: str, schema: str, emitir, log=print, al_conectar=None) -> None:
+    """
+    Bloquea escuchando avisos del tenant; llama emitir(dict) por cada uno.
+    al_conectar() corre cada vez que queda activo el LISTEN: lo que pasó
+    mientras no había conexión no llega como aviso.
+    """
+    with psycopg.connect(database_url, autocommit=True) as conn:
+        conn.execute(f'LISTEN "{canal(schema)}"')
+        log("avisos: escuchando cambios")
+        if al_conectar:
+            al_conectar()
+        for n in conn.notifies():
+            try:
+                emitir(json.loads(n.payload))
+            except Exception as e:
+                log(f"avisos: aviso inválido ({e})")
@@ -0,0 +1,122 @@
+# catalogo.py — instantáneas versionadas del catálogo para las terminales
+#
+# Cada versión es productos.<hash>.json (JSON mínimo) más sus variantes .br y
+# .gz ya comprimidas. El nombre depende del contenido, así que el archivo nunca
+# cambia y se puede servir como immutable: cada terminal baja cada versión una
+# sola vez. manifest.json (chico, sin caché) apunta a la versión vigente.
+import gzip
+import hashlib
+import json
+import os
+import time
+from typing import Dict, Optional
+
+import brotli
+
+# Versiones anteriores que se conservan (una terminal puede ir a medio bajar una)
+VERSIONES_GUARDADAS = 5
+NIVEL_BROTLI = 9  # 11 es notablemente más lento; se publica tras cada ráfaga de ventas
+NIVEL_GZIP = 9
+
+# Accept-Encoding -> extensión del archivo precomprimido, en orden de preferencia
+CODIFICACIONES = (("br", ".br"), ("gzip", ".gz"))
+
+def directorio(data_dir: str) -> str:
+    d = os.path.join(data_dir, "static", "catalogo")
+    os.makedirs(d, exist_ok=True)
+    return d
+
+def _escribir(ruta: str, contenido: bytes) -> None:
+    # Temporal por proceso + rename: quien lea ve el archivo completo o ninguno
+    tmp = f"{ruta}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(contenido)
+    os.replace(tmp, ruta)
+
+def leer_manifest(data_dir: str) -> Optional[Dict]:
+    try:
+        with open(os.path.join(directorio(data_dir), "manifest.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def publicar(data_dir: str, datos: Dict) -> Dict:
+    """Publica `datos` como versión vigente (si no cambió, solo regresa el manifest)."""
+    d = directorio(data_dir)
+    cuerpo = json.dumps(datos, ensure_ascii=False, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    version = hashlib.sha256(cuerpo).hexdigest()[:16]
+
+    actual = leer_manifest(data_dir)
+    if actual and actual.get("version") == version:
+        return actual
+
+    base = os.path.join(d, f"productos.{version}.json")
+    if not os.path.exists(base):
+        # Primero las variantes y al final el .json: su existencia indica versión completa
+        _escribir(base + ".br", brotli.compress(cuerpo, quality=NIVEL_BROTLI))
+        _escribir(base + ".gz", gzip.compress(cuerpo, compresslevel=NIVEL_GZIP, mtime=0))
+        _escribir(base, cuerpo)
+
+    manifest = {
+        "version": version,
+        "url": f"/catalogo/{version}.json",
+        "bytes": len(cuerpo),
+        "productos": len(datos),
+        "publicado": int(time.time()),
+    }
+    _escribir(os.path.join(d, "manifest.json"), json.dumps(manifest).encode("utf-8"))
+    _limpiar(d, version)
+    return manifest
+
+def _limpiar(d: str, vigente: str) -> None:
+    versiones = []
+    for nombre in os.listdir(d):
+        if nombre.startswith("productos.") and nombre.endswith(".json"):
+            versiones.append((os.path.getmtime(os.path.join(d, nombre)), nombre[len("productos."):-len(".json")]))
+    versiones.sort(reverse=True)
+    for _, version in versiones[VERSIONES_GUARDADAS:]:
+        if version == vigente:
+            continue
+        for ext in (".json", ".json.br", ".json.gz"):
+            try:
+                os.remove(os.path.join(d, f"productos.{version}{ext}"))
+            except FileNotFoundError:
+                pass
+
+def _aceptadas(accept_encoding: str) -> Dict[str, float]:
+    """Accept-Encoding -> {codificación: q}; q=0 (o 0.0, 0.000) significa "no"."""
+    aceptadas = {}
+    for parte in (accept_encoding or "").split(","):
+        nombre, *params = [x.strip() for x in parte.split(";")]
+        if not nombre:
+            continue
+        q = 1.0
+        for p in params:
+            k, _, v = p.partition("=")
+            if k.strip().lower() == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        aceptadas[nombre.lower()] = q
+    return aceptadas
+
+def archivo_version(data_dir: str, version: str, accept_encoding: str):
+    """
+    (ruta, codificación) del archivo a servir para la versión, según lo que
+    acepte el cliente; codificación None = JSON sin comprimir. None si no existe.
+    """
+    base = os.path.join(directorio(data_dir), f"productos.{version}.json")
+    if not os.path.exists(base):
+        return None
+    aceptadas = _aceptadas(accept_encoding)
+    comodin = aceptadas.get("*", 0.0)
+    # Mayor q primero; a igual q, el orden de CODIFICACIONES (br antes que gzip)
+    candidatas = sorted(
+        ((aceptadas.get(c, comodin), i, c, ext) for i, (c, ext) in enumerate(CODIFICACIONES)),
+        key=lambda t: (-t[0], t[1]),
+    )
+    for q, _, codificacion, ext in candidatas:
+        if q > 0 and os.path.exists(base + ext):
+            return base + ext, codificacion
+    return base, None
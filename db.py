@@ -1,17 +1,54 @@
 # db.py — Postgres multi-tenant (psycopg3) con COMMIT al salir
+import itertools
 import os
+import time
 import psycopg
 from psycopg.rows import dict_row
-from flask import g
+from flask import g, has_request_context, session
 
 # OJO: sin espacios/saltos de línea
 DATABASE_URL = os.environ["DATABASE_URL"].strip()
 
+# Réplicas de lectura (opcional), separadas por coma. Para probar en local:
+#   DATABASE_REPLICA_URLS=postgresql://localhost:5433/pos,postgresql://localhost:5434/pos
+REPLICA_URLS = [u.strip() for u in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
+# Tras escribir, la misma sesión lee del primario estos segundos (0 = desactivado)
+LEER_ESCRITURAS_SEG = float(os.getenv("REPLICA_LEER_ESCRITURAS_SEG", "5"))
+# Una réplica que no conecta se salta durante este tiempo
+REPLICA_PAUSA_SEG = 30.0
+
+_turno = itertools.count()
+_caidas = {}  # dsn -> momento hasta el que no se intenta
+
+def _conectar_lectura():
+    """Conexión a una réplica (en turno); si ninguna responde, None."""
+    if not REPLICA_URLS:
+        return None
+    if LEER_ESCRITURAS_SEG and has_request_context():
+        if time.time() - session.get("_escrito_en", 0) < LEER_ESCRITURAS_SEG:
+            return None
+    ahora = time.time()
+    inicio = next(_turno)
+    for i in range(len(REPLICA_URLS)):
+        dsn = REPLICA_URLS[(inicio + i) % len(REPLICA_URLS)]
+        if _caidas.get(dsn, 0) > ahora:
+            continue
+        try:
+            return psycopg.connect(dsn, row_factory=dict_row, connect_timeout=2)
+        except psycopg.OperationalError as e:
+            print("replica warning:", e)
+            _caidas[dsn] = ahora + REPLICA_PAUSA_SEG
+    return None
+
 class _WrappedConn:
     """Permite usar placeholders estilo SQLite (?) en tu código actual."""
-    def __init__(self, conn: psycopg.Connection):
+    def __init__(self, conn: psycopg.Connection, ctx=None):
         self._conn = conn
+        self._ctx = ctx
     def execute(self, sql: str, params=()):
+        if self._ctx and sql.strip().upper() == "COMMIT":
+            # COMMIT explícito (BEGIN ... COMMIT en las rutas): anotar la escritura antes
+            self._ctx._marcar_escritura()
         if params:
             sql = sql.replace("?", "%s")
             return self._conn.execute(sql, params)
@@ -21,15 +58,23 @@ class _WrappedConn:
 
 class _DBCtx:
     """Uso: with get_db() as conn: conn.execute(...)."""
+    def __init__(self, solo_lectura: bool = False):
+        self._solo_lectura = solo_lectura
+
     def __enter__(self):
         schema = getattr(g, "tenant_schema", None)
         if not schema:
             raise RuntimeError("Tenant no resuelto (g.tenant_schema vacío)")
-        self._raw = psycopg.connect(DATABASE_URL, row_factory=dict_row)
+        self._raw = _conectar_lectura() if self._solo_lectura else None
+        if self._raw is not None and has_request_context():
+            g.leyo_replica = True  # el caché de respuestas no confía de más en una réplica
+        if self._raw is None:
+            self._raw = psycopg.connect(DATABASE_URL, row_factory=dict_row)
         self._raw.autocommit = False  # manejamos commit/rollback manualmente
+        self._raw.read_only = self._solo_lectura
         with self._raw.cursor() as cur:
             cur.execute(f'SET search_path TO "{schema}", public')
-        return _WrappedConn(self._raw)
+        return _WrappedConn(self._raw, self)
 
     def __exit__(self, exc_type, exc, tb):
         try:
@@ -40,14 +85,27 @@ class _DBCtx:
                     pass
             else:
                 try:
+                    self._marcar_escritura()
                     self._raw.commit()   # <<--- COMMIT EN ÉXITO
                 except Exception:
                     self._raw.rollback()
         finally:
             self._raw.close()
 
-def get_db():
-    return _DBCtx()
+    def _marcar_escritura(self):
+        # Solo si la transacción escribió algo (tiene xid asignado)
+        if not (REPLICA_URLS and LEER_ESCRITURAS_SEG) or self._solo_lectura or not has_request_context():
+            return
+        row = self._raw.execute("SELECT pg_current_xact_id_if_assigned() IS NOT NULL AS escribio").fetchone()
+        if row and row["escribio"]:
+            session["_escrito_en"] = time.time()
+
+def get_db(solo_lectura: bool = False):
+    """
+    solo_lectura=True: la consulta puede ir a una réplica (DATABASE_REPLICA_URLS);
+    sin réplicas disponibles, o justo después de escribir en la sesión, va al primario.
+    """
+    return _DBCtx(solo_lectura)
 
 def init_db():
     # Solo verifica conexión
@@ -0,0 +1,107 @@
+# folios.py — folios compactos (bigint de secuencia) para ventas
+#
+# Los folios de texto V%Y%m%d%H%M%S%f se reemplazan por un bigint de
+# ventas_id_seq: ordenable, sin choques entre cajas y con índices/joins más
+# chicos. ventas_folios guarda el folio anterior para que los links viejos
+# (/ticket/<vid>) sigan funcionando. Hasta que se corre la conversión
+# (flask migrar-folios) las ventas nuevas siguen llevando folio de texto.
+import hashlib
+from datetime import datetime
+from typing import Optional, Union
+
+import psycopg
+
+def id_es_texto(conn: psycopg.Connection, schema: str) -> bool:
+    row = conn.execute(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_schema = %s AND table_name = 'ventas' AND column_name = 'id'",
+        (schema,),
+    ).fetchone()
+    return bool(row) and row[0] == "text"
+
+def folio_texto(momento: datetime, clave: Optional[str] = None) -> str:
+    """
+    Folio de texto como antes de la conversión (solo mientras ventas.id siga
+    siendo text). Con clave (ventas del lote) se deriva de ella: dos cajas en
+    el mismo segundo no chocan y un reintento da el mismo folio.
+    """
+    if clave is None:
+        return momento.strftime("V%Y%m%d%H%M%S%f")
+    return momento.strftime("V%Y%m%d%H%M%S") + "-" + hashlib.sha1(clave.encode("utf-8")).hexdigest()[:10]
+
+def migrar_folios(conn: psycopg.Connection, schema: str, particionada: bool, log=print) -> bool:
+    """
+    Convierte ventas.id / venta_items.venta_id de text a bigint en una sola
+    transacción (reescribe ambas tablas bajo lock exclusivo: correrlo con la
+    tienda cerrada si el historial es grande). Los folios se asignan en orden
+    cronológico; las referencias del libro de inventario se traducen igual.
+    Regresa False si otra instancia ya está migrando.
+    """
+    if not conn.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", (f"{schema}.folios",)).fetchone()[0]:
+        conn.rollback()
+        log("folios: otra instancia ya está migrando")
+        return False
+    if not id_es_texto(conn, schema):
+        conn.commit()
+        return True
+
+    conn.execute('''
+        create sequence if not exists ventas_id_seq;
+        insert into ventas_folios (anterior, id)
+          select id, nextval('ventas_id_seq')
+          from (select id from ventas order by momento nulls first, id) t
+          on conflict do nothing;
+
+        alter table ventas add column id_nuevo bigint;
+        update ventas v set id_nuevo = f.id from ventas_folios f where f.anterior = v.id;
+        alter table venta_items add column venta_id_nuevo bigint;
+        update venta_items vi set venta_id_nuevo = f.id from ventas_folios f where f.anterior = vi.venta_id;
+
+        -- cascade se lleva la PK, la FK de venta_items y sus índices
+        alter table venta_items drop column venta_id cascade;
+        alter table ventas drop column id cascade;
+        alter table ventas rename column id_nuevo to id;
+        alter table venta_items rename column venta_id_nuevo to venta_id;
+        alter table ventas alter column id set not null,
+                           alter column id set default nextval('ventas_id_seq');
+        alter table venta_items alter column venta_id set not null;
+
+        -- Movimientos de venta aún sin compactar: referencia = folio nuevo
+        update inventario_movimientos m set referencia = f.id::text
+          from ventas_folios f
+          where m.tipo = 'venta' and f.anterior = m.referencia;
+        insert into ventas_claves (clave, venta_id)
+          select distinct on (clave) clave, id from ventas where clave is not null
+          order by clave, id
+          on conflict do nothing;
+    ''')
+    if particionada:
+        conn.execute('''
+            alter table ventas add primary key (id, momento);
+            alter table venta_items add foreign key (venta_id, venta_momento)
+              references ventas(id, momento) on delete cascade on update cascade;
+            create index if not exists idx_venta_items_venta on venta_items(venta_id, venta_momento);
+        ''')
+    else:
+        conn.execute('''
+            alter table ventas add primary key (id);
+            alter table venta_items add foreign key (venta_id) references ventas(id) on delete cascade;
+            create index if not exists idx_venta_items_venta on venta_items(venta_id);
+        ''')
+    conn.commit()
+    log("folios: ventas.id convertido a bigint (folios anteriores en ventas_folios)")
+    return True
+
+def folio_resolver(conn, vid: Union[str, int]) -> Optional[Union[int, str]]:
+    """
+    Folio numérico para `vid`. Los folios de texto se traducen con
+    ventas_folios; si no están ahí (p.ej. ventas archivadas antes de la
+    conversión) se regresa el texto tal cual para buscarlo en el archivo.
+    """
+    vid = str(vid or "").strip()
+    if not vid:
+        return None
+    if vid.isdigit():
+        return int(vid)
+    row = conn.execute("SELECT id FROM ventas_folios WHERE anterior = ?", (vid,)).fetchone()
+    return int(row["id"]) if row else vid
@@ -0,0 +1,280 @@
+# particiones.py — ventas / venta_items particionadas por mes sobre `momento`
+#
+# Requiere Postgres 15+ (UPDATE en cascada entre particiones al editar la fecha
+# de una venta). Los nombres de partición son <tabla>_AAAA_MM; lo que caiga
+# fuera de rango va a <tabla>_default.
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import psycopg
+
+from cambios import ddl_avisos_ventas
+from folios import id_es_texto
+
+# momento a partir del texto 'YYYY-MM-DD HH:MM' (o solo fecha) en la zona local
+def momento_sql(col: str, tz: ZoneInfo) -> str:
+    return (
+        f"COALESCE(substring({col} from '^\\d{{4}}-\\d{{2}}-\\d{{2}}(?: \\d{{2}}:\\d{{2}})?')::timestamp "
+        f"AT TIME ZONE '{tz.key}', timestamptz 'epoch')"
+    )
+
+def ddl_ventas(ventas: str = "ventas", items: str = "venta_items", sufijo_idx: str = "") -> str:
+    return f'''
+    create sequence if not exists ventas_id_seq;
+    create table if not exists {ventas}(
+      id      bigint not null default nextval('ventas_id_seq'),
+      momento timestamptz not null,
+      fecha   text not null,
+      cliente text,
+      total   numeric(12,2) not null default 0,
+      extra   text,
+      clave   text,
+      redondeo    numeric(12,2),
+      extra_jsonb jsonb,
+      primary key (id, momento)
+    ) partition by range (momento);
+    create table if not exists {ventas}_default partition of {ventas} default;
+    create unique index if not exists ux_ventas_clave{sufijo_idx} on {ventas}(clave, momento);
+    create index if not exists idx_ventas_momento{sufijo_idx} on {ventas}(momento);
+    create index if not exists idx_ventas_redondeo{sufijo_idx} on {ventas}(momento) where redondeo > 0;
+    create index if not exists idx_ventas_sin_tipar{sufijo_idx} on {ventas}(momento) where redondeo is null;
+
+    create table if not exists {items}(
+      id              bigserial,
+      venta_id        bigint not null,
+      venta_momento   timestamptz not null,
+      producto_id     text not null references productos(id),
+      cantidad        integer not null,
+      precio_unitario numeric(12,2) not null,
+      primary key (id, venta_momento),
+      foreign key (venta_id, venta_momento) references {ventas}(id, momento)
+        on delete cascade on update cascade
+    ) partition by range (venta_momento);
+    create table if not exists {items}_default partition of {items} default;
+    create index if not exists idx_venta_items_venta{sufijo_idx} on {items}(venta_id, venta_momento);
+    create index if not exists idx_venta_items_producto{sufijo_idx} on {items}(producto_id);
+    '''
+
+def es_particionada(conn: psycopg.Connection, schema: str, tabla: str) -> bool:
+    row = conn.execute(
+        "SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = %s AND c.relname = %s",
+        (schema, tabla),
+    ).fetchone()
+    return bool(row) and row[0] == "p"
+
+def _mes_siguiente(anio: int, mes: int):
+    return (anio + 1, 1) if mes == 12 else (anio, mes + 1)
+
+def asegurar_particiones(conn: psycopg.Connection, tz: ZoneInfo, desde: datetime = None,
+                         meses_adelante: int = 3, ventas: str = "ventas",
+                         items: str = "venta_items") -> None:
+    """Crea (idempotente) las particiones mensuales desde `desde` hasta hoy + meses_adelante."""
+    hoy = datetime.now(tz)
+    anio, mes = (desde or hoy).year, (desde or hoy).month
+    fin = (hoy.year, hoy.month)
+    for _ in range(meses_adelante):
+        fin = _mes_siguiente(*fin)
+
+    while (anio, mes) <= fin:
+        sig = _mes_siguiente(anio, mes)
+        ini_txt = datetime(anio, mes, 1, tzinfo=tz).isoformat()
+        fin_txt = datetime(sig[0], sig[1], 1, tzinfo=tz).isoformat()
+        for padre, nombre in ((ventas, "ventas"), (items, "venta_items")):
+            conn.execute(
+                f"create table if not exists {nombre}_{anio:04d}_{mes:02d} partition of {padre} "
+                f"for values from ('{ini_txt}') to ('{fin_txt}')"
+            )
+        anio, mes = sig
+    conn.commit()
+
+def ddl_legacy_sin_fk() -> str:
+    """
+    venta_items_legacy es solo respaldo: sin su FK a productos, purgar un
+    producto que solo aparece ahí no falla (ni tumba el lote de la purga).
+    """
+    return '''
+    do $$
+    declare r record;
+    begin
+      if to_regclass('venta_items_legacy') is not null then
+        for r in select conname from pg_constraint
+                 where conrelid = 'venta_items_legacy'::regclass and contype = 'f'
+                   and confrelid = 'productos'::regclass loop
+          execute format('alter table venta_items_legacy drop constraint %I', r.conname);
+        end loop;
+      end if;
+    end $$;
+    '''
+
+def migrar_a_particiones(database_url: str, schema: str, tz: ZoneInfo,
+                         lote: int = 5000, log=print) -> None:
+    """
+    Mueve ventas/venta_items heredadas (sin particionar) a tablas particionadas
+    sin detener la tienda: rellena `momento`, crea las tablas nuevas, las
+    mantiene sincronizadas con triggers, copia por lotes y al final intercambia
+    nombres en una transacción corta. Las tablas viejas quedan como *_legacy.
+    """
+    with psycopg.connect(database_url) as conn:
+        conn.execute(f'SET search_path TO "{schema}", public')
+        # Un solo migrador por tenant aunque haya varios workers
+        if not conn.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (f"{schema}.particionar",)).fetchone()[0]:
+            log("particionar: otra instancia ya está migrando")
+            return
+        conn.commit()
+        if es_particionada(conn, schema, "ventas"):
+            log("particionar: ventas ya está particionada")
+            return
+        if id_es_texto(conn, schema):
+            # Las tablas particionadas usan folio bigint
+            log("particionar: faltan los folios numéricos (flask migrar-folios)")
+            return
+
+        # 1) momento / venta_momento en las tablas heredadas, por lotes
+        n = 1
+        while n:
+            n = conn.execute(
+                f"UPDATE ventas SET momento = {momento_sql('fecha', tz)} "
+                "WHERE id IN (SELECT id FROM ventas WHERE momento IS NULL LIMIT %s)",
+                (lote,),
+            ).rowcount
+            conn.commit()
+        n = 1
+        while n:
+            n = conn.execute(
+                "UPDATE venta_items vi SET venta_momento = v.momento FROM ventas v "
+                "WHERE v.id = vi.venta_id AND vi.id IN "
+                "(SELECT id FROM venta_items WHERE venta_momento IS NULL LIMIT %s)",
+                (lote,),
+            ).rowcount
+            conn.commit()
+        log("particionar: momento rellenado")
+
+        # 2) tablas nuevas y particiones para todo el rango existente
+        conn.execute(ddl_ventas("ventas_part", "venta_items_part", "_part"))
+        conn.execute("ALTER TABLE venta_items_part ALTER COLUMN id SET DEFAULT nextval('venta_items_id_seq')")
+        primero = conn.execute("SELECT min(momento) FROM ventas WHERE momento > 'epoch'").fetchone()[0]
+        conn.commit()
+        asegurar_particiones(conn, tz, primero.astimezone(tz) if primero else None,
+                             ventas="ventas_part", items="venta_items_part")
+
+        # 3) triggers espejo mientras dura la copia
+        conn.execute(f'''
+        create or replace function ventas_espejo() returns trigger language plpgsql as $$
+        begin
+          if tg_op = 'DELETE' then
+            delete from ventas_part where id = old.id;
+            return null;
+          end if;
+          new.momento := coalesce(new.momento, {momento_sql('new.fecha', tz)});
+          if tg_op = 'UPDATE' then
+            update ventas_part set momento = new.momento, fecha = new.fecha, cliente = new.cliente,
+                   total = new.total, extra = new.extra, clave = new.clave,
+                   redondeo = new.redondeo, extra_jsonb = new.extra_jsonb
+             where id = old.id;
+            if found then return null; end if;
+          end if;
+          insert into ventas_part (id, momento, fecha, cliente, total, extra, clave, redondeo, extra_jsonb)
+          values (new.id, new.momento, new.fecha, new.cliente, new.total, new.extra, new.clave,
+                  new.redondeo, new.extra_jsonb)
+          on conflict do nothing;
+          return null;
+        end $$;
+
+        create or replace function venta_items_espejo() returns trigger language plpgsql as $$
+        begin
+          if tg_op in ('DELETE', 'UPDATE') then
+            delete from venta_items_part where id = old.id;
+          end if;
+          if tg_op in ('INSERT', 'UPDATE') then
+            insert into venta_items_part (id, venta_id, venta_momento, producto_id, cantidad, precio_unitario)
+            select new.id, v.id, v.momento, new.producto_id, new.cantidad, new.precio_unitario
+              from ventas_part v where v.id = new.venta_id
+            on conflict do nothing;
+          end if;
+          return null;
+        end $$;
+
+        drop trigger if exists trg_ventas_espejo on ventas;
+        create trigger trg_ventas_espejo after insert or update or delete on ventas
+          for each row execute function ventas_espejo();
+        drop trigger if exists trg_venta_items_espejo on venta_items;
+        create trigger trg_venta_items_espejo after insert or update or delete on venta_items
+          for each row execute function venta_items_espejo();
+        ''')
+        conn.commit()
+        log("particionar: triggers espejo instalados")
+
+        # 4) copia por lotes (cada lote en su propia transacción)
+        ultimo = 0
+        while True:
+            tope = conn.execute(
+                "SELECT max(id) FROM (SELECT id FROM ventas WHERE id > %s ORDER BY id LIMIT %s) t",
+                (ultimo, lote),
+            ).fetchone()[0]
+            if tope is None:
+                conn.commit()
+                break
+            conn.execute(
+                "INSERT INTO ventas_part (id, momento, fecha, cliente, total, extra, clave, redondeo, extra_jsonb) "
+                "SELECT id, momento, fecha, cliente, total, extra, clave, redondeo, extra_jsonb FROM ventas "
+                "WHERE id > %s AND id <= %s "
+                "ON CONFLICT DO NOTHING",
+                (ultimo, tope),
+            )
+            conn.commit()
+            ultimo = tope
+        log("particionar: ventas copiadas")
+
+        ultimo_item = 0
+        while True:
+            tope = conn.execute(
+                "SELECT max(id) FROM (SELECT id FROM venta_items WHERE id > %s ORDER BY id LIMIT %s) t",
+                (ultimo_item, lote),
+            ).fetchone()[0]
+            if tope is None:
+                conn.commit()
+                break
+            conn.execute(
+                "INSERT INTO venta_items_part (id, venta_id, venta_momento, producto_id, cantidad, precio_unitario) "
+                "SELECT vi.id, v.id, v.momento, vi.producto_id, vi.cantidad, vi.precio_unitario "
+                "FROM venta_items vi JOIN ventas_part v ON v.id = vi.venta_id "
+                "WHERE vi.id > %s AND vi.id <= %s "
+                "ON CONFLICT DO NOTHING",
+                (ultimo_item, tope),
+            )
+            conn.commit()
+            ultimo_item = tope
+        log("particionar: venta_items copiados")
+
+        # 5) intercambio atómico (bloqueo breve de escrituras)
+        conn.execute("LOCK TABLE ventas, venta_items IN EXCLUSIVE MODE")
+        conn.execute('''
+            drop trigger trg_ventas_espejo on ventas;
+            drop trigger trg_venta_items_espejo on venta_items;
+            drop function ventas_espejo();
+            drop function venta_items_espejo();
+
+            alter table ventas rename to ventas_legacy;
+            alter table venta_items rename to venta_items_legacy;
+            alter index if exists ux_ventas_clave rename to ux_ventas_clave_legacy;
+            alter index if exists idx_venta_items_venta rename to idx_venta_items_venta_legacy;
+            alter index if exists idx_ventas_momento rename to idx_ventas_momento_legacy;
+            alter index if exists idx_ventas_redondeo rename to idx_ventas_redondeo_legacy;
+            alter index if exists idx_ventas_sin_tipar rename to idx_ventas_sin_tipar_legacy;
+            alter index if exists idx_venta_items_producto rename to idx_venta_items_producto_legacy;
+
+            alter table ventas_part rename to ventas;
+            alter table venta_items_part rename to venta_items;
+            alter table ventas_part_default rename to ventas_default;
+            alter table venta_items_part_default rename to venta_items_default;
+            alter index ux_ventas_clave_part rename to ux_ventas_clave;
+            alter index idx_ventas_momento_part rename to idx_ventas_momento;
+            alter index idx_ventas_redondeo_part rename to idx_ventas_redondeo;
+            alter index idx_ventas_sin_tipar_part rename to idx_ventas_sin_tipar;
+            alter index idx_venta_items_venta_part rename to idx_venta_items_venta;
+            alter index idx_venta_items_producto_part rename to idx_venta_items_producto;
+            alter sequence venta_items_id_seq owned by venta_items.id;
+        ''' + ddl_legacy_sin_fk() + ddl_avisos_ventas())
+        conn.commit()
+        log("particionar: listo (tablas anteriores en ventas_legacy / venta_items_legacy)")
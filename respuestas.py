@@ -0,0 +1,64 @@
+# respuestas.py — caché en memoria de respuestas por versión de datos
+#
+# La clave es (tenant, endpoint, parámetros, versión de datos del tenant).
+# Toda escritura a ventas sube la versión del tenant: las entradas anteriores
+# ya no coinciden y salen solas por LRU. Una carga repetida sin ventas nuevas
+# cuesta una búsqueda en un dict (y un 304 si el navegador ya tiene el cuerpo).
+# `ttl_max` acota la vida de toda entrada, por si se pierde un aviso de cambio.
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+class CacheRespuestas:
+    def __init__(self, max_bytes: int, max_entradas: int = 512, ttl_max: Optional[float] = None):
+        self.max_bytes = max_bytes
+        self.max_entradas = max_entradas
+        self.ttl_max = ttl_max
+        self._entradas = OrderedDict()  # clave -> (cuerpo, etag, caduca)
+        self._bytes = 0
+        self._versiones: Dict[str, int] = {}
+
+    def version(self, tenant: str) -> int:
+        return self._versiones.get(tenant, 0)
+
+    def subir(self, tenant: str) -> None:
+        """Marca los datos del tenant como cambiados."""
+        self._versiones[tenant] = self.version(tenant) + 1
+
+    def clave(self, tenant: str, endpoint: str, args) -> Tuple:
+        # args es un MultiDict (request.args) o un dict: se ordena para que
+        # ?a=1&b=2 y ?b=2&a=1 coincidan
+        pares = args.items(multi=True) if hasattr(args, "getlist") else args.items()
+        return (tenant, endpoint, tuple(sorted(pares)), self.version(tenant))
+
+    def obtener(self, clave: Tuple) -> Optional[Tuple[bytes, str]]:
+        entrada = self._entradas.get(clave)
+        if entrada is None:
+            return None
+        cuerpo, etag, caduca = entrada
+        if caduca and time.time() > caduca:
+            self._quitar(clave)
+            return None
+        self._entradas.move_to_end(clave)
+        return cuerpo, etag
+
+    def guardar(self, clave: Tuple, cuerpo: bytes, ttl: Optional[float] = None) -> Tuple[bytes, str]:
+        """Guarda el cuerpo (caduca en `ttl` o `ttl_max`, lo menor) y regresa (cuerpo, etag)."""
+        etag = f"{clave[3]}-{hashlib.sha1(cuerpo).hexdigest()}"
+        if len(cuerpo) > self.max_bytes // 4:
+            # Una respuesta enorme desplazaría todo lo demás: se sirve sin guardar
+            return cuerpo, etag
+        if self.ttl_max:
+            ttl = min(ttl, self.ttl_max) if ttl else self.ttl_max
+        if clave in self._entradas:
+            self._quitar(clave)
+        self._entradas[clave] = (cuerpo, etag, time.time() + ttl if ttl else None)
+        self._bytes += len(cuerpo)
+        while self._entradas and (self._bytes > self.max_bytes or len(self._entradas) > self.max_entradas):
+            self._quitar(next(iter(self._entradas)))
+        return cuerpo, etag
+
+    def _quitar(self, clave: Tuple) -> None:
+        cuerpo, _, _ = self._entradas.pop(clave)
+        self._bytes -= len(cuerpo)
@@ -1,55 +1,797 @@
 # store.py
-from typing import Dict, List
+import csv
+import math
+from typing import BinaryIO, Dict, Iterator, List, Optional
+from zoneinfo import ZoneInfo
 from db import get_db
+from folios import folio_texto
+from particiones import momento_sql
 
 # -------- Productos --------
 
+# Stock vigente = foto en productos.stock + movimientos aún no compactados.
+# La suma puede quedar negativa (se vendió más de lo registrado): el libro la
+# guarda tal cual y solo lo que se muestra se acota en 0.
+_MOV_PENDIENTES = """
+    LEFT JOIN (
+        SELECT producto_id, SUM(delta) AS delta
+        FROM inventario_movimientos
+        GROUP BY producto_id
+    ) m ON m.producto_id = p.id
+"""
+
 def productos_listar() -> List[Dict]:
     with get_db() as conn:
         cur = conn.execute(
-            "SELECT id, nombre, precio, stock, categoria FROM productos ORDER BY nombre"
+            "SELECT p.id, p.nombre, p.precio, GREATEST(0, p.stock + COALESCE(m.delta, 0)) AS stock, p.categoria , p.proveedor_id "
+            "FROM productos p" + _MOV_PENDIENTES + "WHERE p.activo ORDER BY p.nombre"
         )
         rows = cur.fetchall()
         return [dict(r) for r in rows]
 
+def productos_por_ids(ids: List[str]) -> List[Dict]:
+    """Productos activos con esos ids (para refrescar filas sueltas en los paneles)."""
+    if not ids:
+        return []
+    with get_db() as conn:
+        return [dict(r) for r in conn.execute(
+            "SELECT p.id, p.nombre, p.precio, GREATEST(0, p.stock + COALESCE(m.delta, 0)) AS stock, p.categoria , p.proveedor_id "
+            "FROM productos p" + _MOV_PENDIENTES + "WHERE p.activo AND p.id = ANY(?)",
+            (list(ids),),
+        ).fetchall()]
+
+# Estado de inventario (mismos cortes que almacen.html)
+_ESTADOS = {
+    "Agotado": "s.stock <= 0",
+    "Por acabarse": "s.stock BETWEEN 1 AND 5",
+    "Stock suficiente": "s.stock > 5",
+}
+
+def productos_buscar(q: str = "", categoria: str = "", estado: str = "",
+                     pagina: int = 1, por_pagina: int = 50,
+                     incluir_manuales: bool = False) -> Dict:
+    """
+    Búsqueda paginada en el catálogo: prefijo / subcadena / difusa (pg_trgm)
+    sobre nombre y código. Regresa la página, el total y conteos por categoría
+    del conjunto encontrado (sin aplicar el filtro de categoría).
+    """
+    q = (q or "").strip()
+    pagina = max(1, int(pagina or 1))
+    por_pagina = min(200, max(1, int(por_pagina or 50)))
+
+    conds, params = [], []
+    if not incluir_manuales:
+        conds.append("upper(COALESCE(s.categoria, '')) <> 'MANUAL'")
+    if q:
+        # ILIKE usa los índices trigram; %% es el operador de similitud (difusa)
+        conds.append("(s.nombre ILIKE ? OR s.id ILIKE ? OR s.nombre %% ?)")
+        params += [f"%{q}%", f"{q}%", q]
+    if estado in _ESTADOS:
+        conds.append(_ESTADOS[estado])
+    where = (" WHERE " + " AND ".join(conds)) if conds else ""
+
+    base = (
+        "WITH s AS ("
+        "  SELECT p.id, p.nombre, p.precio, GREATEST(0, p.stock + COALESCE(m.delta, 0)) AS stock, p.categoria, p.proveedor_id"
+        "  FROM productos p" + _MOV_PENDIENTES + "WHERE p.activo"
+        ") "
+    )
+    filtro_cat = ""
+    params_cat: List = []
+    if categoria:
+        filtro_cat = (" AND " if where else " WHERE ") + "COALESCE(s.categoria, '') = ?"
+        params_cat = [categoria]
+
+    with get_db() as conn:
+        rows = conn.execute(
+            base +
+            "SELECT s.*, COUNT(*) OVER () AS total FROM s" + where + filtro_cat +
+            " ORDER BY (s.id = ?) DESC, (s.nombre ILIKE ?) DESC, similarity(s.nombre, ?) DESC, s.nombre"
+            " LIMIT ? OFFSET ?",
+            params + params_cat + [q, f"{q}%", q, por_pagina, (pagina - 1) * por_pagina],
+        ).fetchall()
+        facetas = conn.execute(
+            base +
+            "SELECT COALESCE(s.categoria, '') AS categoria, COUNT(*) AS n FROM s" + where +
+            " GROUP BY 1 ORDER BY 1",
+            params,
+        ).fetchall()
+
+    total = int(rows[0]["total"]) if rows else 0
+    return {
+        "total": total,
+        "pagina": pagina,
+        "por_pagina": por_pagina,
+        "productos": [{k: r[k] for k in ("id", "nombre", "precio", "stock", "categoria", "proveedor_id")} for r in rows],
+        "categorias": [dict(f) for f in facetas],
+    }
+
 def productos_guardar(p: Dict) -> str:
     """
-    p = { id, nombre, precio, stock, categoria }
+    p = { id, nombre, precio, stock, categoria, proveedor_id? }
     Inserta o actualiza por id (UPSERT en SQLite).
+    Si no viene proveedor_id se conserva el proveedor asignado.
     """
     pid = str(p.get("id") or "").strip()
     nombre = (p.get("nombre") or "").strip()
     precio = float(p.get("precio") or 0)
     stock = int(p.get("stock") or 0)
     categoria = (p.get("categoria") or "").strip()
+    con_proveedor = "proveedor_id" in p
+    proveedor_id = str(p.get("proveedor_id") or "").strip() or None
 
     if not pid or not nombre:
         raise ValueError("Faltan campos obligatorios (id, nombre)")
 
     with get_db() as conn:
+        # El stock no se sobrescribe: la diferencia contra el stock vigente
+        # se anota como movimiento para no pisar ventas en curso.
         conn.execute(
             """
-            INSERT INTO productos (id, nombre, precio, stock, categoria)
-            VALUES (?, ?, ?, ?, ?)
+            INSERT INTO productos (id, nombre, precio, stock, categoria, proveedor_id)
+            VALUES (?, ?, ?, 0, ?, ?)
             ON CONFLICT(id) DO UPDATE SET
                 nombre=excluded.nombre,
                 precio=excluded.precio,
-                stock=excluded.stock,
-                categoria=excluded.categoria
+                categoria=excluded.categoria,
+                activo=TRUE,
+                deleted_at=NULL,
+                proveedor_id=CASE WHEN ? THEN excluded.proveedor_id ELSE productos.proveedor_id END
             """,
-            (pid, nombre, precio, stock, categoria),
+            (pid, nombre, precio, categoria, proveedor_id, con_proveedor),
         )
+        delta = stock - inventario_stock(conn, pid)
+        if delta:
+            inventario_registrar(
+                conn, [pid], [delta], "reabasto" if delta > 0 else "ajuste"
+            )
     return pid
 
-def productos_eliminar(pid: str) -> None:
+# Columnas del CSV de catálogo. La fila de encabezado dice en qué orden vienen;
+# "proveedor" es opcional (id de un proveedor ya dado de alta).
+COLUMNAS_CSV = ("codigo", "nombre", "precio", "stock", "categoria", "proveedor")
+_COLUMNAS_CSV_OBLIGATORIAS = COLUMNAS_CSV[:5]
+
+def _columnas_csv(encabezado: bytes) -> List[str]:
+    """Columnas según el encabezado; uno sin nombres conocidos se toma en el orden clásico."""
+    linea = encabezado.decode("utf-8-sig").strip()
+    nombres = [c.strip().lower() for c in next(csv.reader([linea]), [])]
+    if nombres and all(c in COLUMNAS_CSV for c in nombres):
+        if len(set(nombres)) != len(nombres):
+            raise ValueError("Columnas repetidas en el encabezado")
+        faltan = [c for c in _COLUMNAS_CSV_OBLIGATORIAS if c not in nombres]
+        if faltan:
+            raise ValueError(f"Faltan columnas: {', '.join(faltan)}")
+        return nombres
+    if len(nombres) == 5:
+        return list(COLUMNAS_CSV[:5])
+    raise ValueError(f"Encabezado no reconocido; columnas válidas: {', '.join(COLUMNAS_CSV)}")
+
+def productos_importar_csv(fuente: BinaryIO) -> Dict:
+    """
+    Carga masiva del catálogo: COPY del CSV a una tabla temporal y un solo
+    UPSERT set-based sobre productos. Las diferencias de stock se anotan como
+    movimientos de inventario. Con columna "proveedor" se asigna el proveedor
+    (vacío lo quita; uno que no existe deja el actual y se cuenta aparte).
+    Regresa conteos de insertados/actualizados/rechazados.
+    """
+    columnas = _columnas_csv(fuente.readline())
+    with get_db() as conn:
+        conn.execute(
+            "CREATE TEMP TABLE _import_productos "
+            "(codigo text, nombre text, precio text, stock text, categoria text, proveedor text) ON COMMIT DROP"
+        )
+        with conn.cursor() as cur:
+            # El encabezado ya se leyó: el resto del stream son solo datos
+            with cur.copy(
+                f"COPY _import_productos ({', '.join(columnas)}) "
+                "FROM STDIN WITH (FORMAT csv, HEADER false, ENCODING 'UTF8')"
+            ) as copy:
+                while chunk := fuente.read(1 << 16):
+                    copy.write(chunk)
+
+        # Validación en un solo lugar: precio >= 0 y todo dentro de numeric(12,2) /
+        # integer, así un valor enorme se rechaza en su fila y no aborta la importación.
+        # La última fila gana si un código se repite; COUNT(*) OVER () se evalúa
+        # antes del DISTINCT ON, así que cuenta todas las válidas.
+        conn.execute(
+            r"""
+            CREATE TEMP TABLE _import_ok ON COMMIT DROP AS
+            WITH validas AS (
+                SELECT ctid, trim(codigo) AS codigo, trim(nombre) AS nombre,
+                       trim(precio)::numeric(12,2) AS precio,
+                       COALESCE(NULLIF(trim(stock), ''), '0')::integer AS stock,
+                       COALESCE(trim(categoria), '') AS categoria,
+                       trim(proveedor) AS proveedor
+                FROM _import_productos
+                WHERE COALESCE(trim(codigo), '') <> ''
+                  AND COALESCE(trim(nombre), '') <> ''
+                  AND trim(precio) ~ '^\d{1,9}(\.\d+)?$'
+                  AND COALESCE(NULLIF(trim(stock), ''), '0') ~ '^-?\d{1,9}$'
+            )
+            SELECT DISTINCT ON (codigo) codigo, nombre, precio, stock, categoria, proveedor,
+                   COUNT(*) OVER () AS validas
+            FROM validas
+            ORDER BY codigo, ctid DESC
+            """
+        )
+        leidas = conn.execute("SELECT COUNT(*) AS n FROM _import_productos").fetchone()["n"]
+        fila = conn.execute("SELECT validas AS n FROM _import_ok LIMIT 1").fetchone()
+        validas = fila["n"] if fila else 0
+
+        # Stock vigente antes del upsert, para anotar solo la diferencia
+        conn.execute(
+            "CREATE TEMP TABLE _import_delta ON COMMIT DROP AS "
+            "SELECT i.codigo, i.stock - COALESCE(p.stock + COALESCE(m.delta, 0), 0) AS delta "
+            "FROM _import_ok i LEFT JOIN productos p ON p.id = i.codigo" + _MOV_PENDIENTES
+        )
+
+        res = conn.execute(
+            """
+            WITH up AS (
+                INSERT INTO productos (id, nombre, precio, stock, categoria)
+                SELECT codigo, nombre, precio, 0, categoria FROM _import_ok
+                ON CONFLICT(id) DO UPDATE SET
+                    nombre=excluded.nombre,
+                    precio=excluded.precio,
+                    categoria=excluded.categoria,
+                    activo=TRUE,
+                    deleted_at=NULL
+                RETURNING (xmax = 0) AS insertado
+            )
+            SELECT COUNT(*) FILTER (WHERE insertado) AS insertados,
+                   COUNT(*) FILTER (WHERE NOT insertado) AS actualizados
+            FROM up
+            """
+        ).fetchone()
+
+        conn.execute(
+            """
+            INSERT INTO inventario_movimientos (producto_id, tipo, delta, referencia)
+            SELECT codigo, CASE WHEN delta > 0 THEN 'reabasto' ELSE 'ajuste' END, delta, 'importacion'
+            FROM _import_delta WHERE delta <> 0
+            """
+        )
+
+        sin_proveedor = 0
+        if "proveedor" in columnas:
+            conn.execute(
+                """
+                UPDATE productos p SET proveedor_id = NULLIF(i.proveedor, '')
+                FROM _import_ok i
+                WHERE p.id = i.codigo
+                  AND (COALESCE(i.proveedor, '') = ''
+                       OR EXISTS (SELECT 1 FROM proveedores pr WHERE pr.id = i.proveedor))
+                  AND p.proveedor_id IS DISTINCT FROM NULLIF(i.proveedor, '')
+                """
+            )
+            sin_proveedor = conn.execute(
+                "SELECT COUNT(*) AS n FROM _import_ok i "
+                "WHERE COALESCE(i.proveedor, '') <> '' "
+                "AND NOT EXISTS (SELECT 1 FROM proveedores pr WHERE pr.id = i.proveedor)"
+            ).fetchone()["n"]
+
+    return {
+        "insertados": int(res["insertados"] or 0),
+        "actualizados": int(res["actualizados"] or 0),
+        "rechazados": int(leidas) - int(validas),
+        "duplicados": int(validas) - int(res["insertados"] or 0) - int(res["actualizados"] or 0),
+        "proveedor_desconocido": int(sin_proveedor),
+    }
+
+def productos_ajuste_masivo(categoria: Optional[str] = None, ids: Optional[List[str]] = None,
+                            precio_modo: Optional[str] = None, precio_valor: float = 0,
+                            stock_modo: Optional[str] = None, stock_valor: int = 0,
+                            simular: bool = False, muestra: int = 50) -> Dict:
+    """
+    Ajuste de precio (porcentaje | monto) y/o stock (fijar | sumar) para una
+    categoría o lista de ids, en una sola sentencia. Con simular=True solo
+    regresa la vista previa. El stock se ajusta con movimientos de inventario.
+    """
+    if categoria is None and not ids:
+        raise ValueError("Indica una categoría o una lista de ids")
+    if precio_modo not in (None, "porcentaje", "monto") or stock_modo not in (None, "fijar", "sumar"):
+        raise ValueError("Modo de ajuste inválido")
+    if precio_modo == "porcentaje" and not precio_valor > -100:
+        raise ValueError("El porcentaje debe ser mayor a -100")
+
+    if categoria is not None:
+        filtro, params = "COALESCE(p.categoria, '') = ?", [categoria]
+    else:
+        filtro, params = "p.id = ANY(?)", [list(ids)]
+
+    if precio_modo == "porcentaje":
+        precio_expr = "GREATEST(0, round(precio_antes * (1 + ?::numeric / 100), 2))"
+        params.append(precio_valor)
+    elif precio_modo == "monto":
+        precio_expr = "GREATEST(0, precio_antes + ?::numeric)"
+        params.append(precio_valor)
+    else:
+        precio_expr = "precio_antes"
+
+    if stock_modo == "fijar":
+        stock_expr = "GREATEST(0, ?::integer)"
+        params.append(stock_valor)
+    elif stock_modo == "sumar":
+        stock_expr = "GREATEST(0, stock_antes + ?::integer)"
+        params.append(stock_valor)
+    else:
+        stock_expr = "stock_antes"
+
+    calc = (
+        "WITH objetivo AS ("
+        "  SELECT p.id, p.nombre, p.precio AS precio_antes,"
+        "         p.stock + COALESCE(m.delta, 0) AS stock_libro,"
+        "         GREATEST(0, p.stock + COALESCE(m.delta, 0)) AS stock_antes"
+        "  FROM productos p" + _MOV_PENDIENTES + "WHERE p.activo AND " + filtro +
+        "), calc AS ("
+        f"  SELECT id, nombre, precio_antes, stock_libro, stock_antes, {precio_expr} AS precio_despues,"
+        f"         {stock_expr} AS stock_despues"
+        "  FROM objetivo"
+        ") "
+    )
+
+    with get_db() as conn:
+        previa = conn.execute(
+            calc + "SELECT *, COUNT(*) OVER () AS total FROM calc ORDER BY nombre LIMIT ?",
+            params + [muestra],
+        ).fetchall()
+        total = int(previa[0]["total"]) if previa else 0
+        if not simular and total:
+            conn.execute(
+                calc +
+                """
+                , upd AS (
+                    UPDATE productos p SET precio = c.precio_despues
+                    FROM calc c
+                    WHERE p.id = c.id AND p.precio IS DISTINCT FROM c.precio_despues
+                ), mov AS (
+                    INSERT INTO inventario_movimientos (producto_id, tipo, delta, referencia)
+                    SELECT id, CASE WHEN stock_despues > stock_libro THEN 'reabasto' ELSE 'ajuste' END,
+                           stock_despues - stock_libro, 'ajuste_masivo'
+                    FROM calc WHERE stock_despues <> stock_libro
+                )
+                SELECT COUNT(*) AS n FROM calc
+                """,
+                params,
+            )
+
+    return {
+        "afectados": total,
+        "simulado": simular,
+        "muestra": [
+            {k: r[k] for k in ("id", "nombre", "precio_antes", "precio_despues", "stock_antes", "stock_despues")}
+            for r in previa
+        ],
+    }
+
+def productos_eliminar(pid: str) -> bool:
+    """
+    Baja lógica: el producto deja de verse en el catálogo pero sus ventas
+    (tickets, reportes) quedan intactas. Regresa False si no existía.
+    """
     pid = str(pid or "").strip()
     if not pid:
+        return False
+    with get_db() as conn:
+        cur = conn.execute(
+            "UPDATE productos SET activo = FALSE, deleted_at = now() WHERE id = ? AND activo",
+            (pid,),
+        )
+        return cur.rowcount > 0
+
+def productos_purgar(dias: int = 30, limite: int = 500) -> int:
+    """
+    Borra de verdad hasta `limite` productos dados de baja hace más de `dias`
+    que ya no aparecen en ninguna venta (venta_items_legacy, si existe, ya no
+    tiene FK a productos: ver particiones.ddl_legacy_sin_fk). Lotes chicos con SKIP LOCKED para no
+    estorbar a las cajas. Regresa cuántos se borraron.
+    """
+    with get_db() as conn:
+        cur = conn.execute(
+            """
+            DELETE FROM productos WHERE id IN (
+                SELECT p.id FROM productos p
+                WHERE NOT p.activo
+                  AND p.deleted_at < now() - make_interval(days => ?)
+                  AND NOT EXISTS (SELECT 1 FROM venta_items vi WHERE vi.producto_id = p.id)
+                LIMIT ?
+                FOR UPDATE SKIP LOCKED
+            )
+            """,
+            (dias, limite),
+        )
+        return cur.rowcount
+
+
+# -------- Ventas --------
+
+def _reservar_folios(conn, validas: List[Dict]):
+    """({clave: folio nuevo}, {clave: folio original}) con ventas_claves y ventas_id_seq."""
+    # ventas_claves (PK = clave) decide qué es nuevo y reserva el folio;
+    # un reintento con otra hora no escapa a la deduplicación
+    rows = conn.execute(
+        """
+        INSERT INTO ventas_claves (clave, venta_id)
+        SELECT c, nextval('ventas_id_seq') FROM unnest(?::text[]) AS c
+        ON CONFLICT DO NOTHING
+        RETURNING clave, venta_id
+        """,
+        ([v['clave'] for v in validas],),
+    ).fetchall()
+    nuevas = {r['clave']: r['venta_id'] for r in rows}
+
+    repetidas = [v['clave'] for v in validas if v['clave'] not in nuevas]
+    originales = {
+        r['clave']: r['venta_id'] for r in conn.execute(
+            "SELECT clave, venta_id FROM ventas_claves WHERE clave = ANY(?)", (repetidas,)
+        ).fetchall()
+    } if repetidas else {}
+    return nuevas, originales
+
+def _reservar_folios_texto(conn, validas: List[Dict]):
+    """Lo mismo con folios de texto (antes de migrar-folios): ventas.clave decide."""
+    # Sin ventas_claves no hay PK que arbitre: los lotes se serializan entre sí
+    conn.execute("SELECT pg_advisory_xact_lock(hashtext('ventas_lote'))")
+    originales = {
+        r['clave']: r['id'] for r in conn.execute(
+            "SELECT DISTINCT ON (clave) clave, id FROM ventas WHERE clave = ANY(?) ORDER BY clave, id",
+            ([v['clave'] for v in validas],),
+        ).fetchall()
+    }
+    nuevas = {v['clave']: folio_texto(v['momento'], v['clave'])
+              for v in validas if v['clave'] not in originales}
+    return nuevas, originales
+
+def ventas_registrar_lote(ventas: List[Dict], folios_texto: bool = False) -> Dict:
+    """
+    ventas = [{ clave, momento, fecha, total, redondeo, extra, items: [{producto_id, cantidad, precio_unitario}] }]
+    Inserta todas las ventas en una sola transacción con inserts masivos y
+    los movimientos de inventario en bloque. Las claves ya registradas se ignoran,
+    así que reintentar el mismo lote no duplica nada: las duplicadas regresan
+    con el folio original para que la caja concilie. Los folios los asigna
+    ventas_id_seq (o, con `folios_texto`, el formato de texto anterior).
+    """
+    resultado = {'insertadas': [], 'duplicadas': [], 'rechazadas': []}
+    if not ventas:
+        return resultado
+
+    with get_db() as conn:
+        # Ventas con productos inexistentes romperían la FK de venta_items
+        pids = sorted({it['producto_id'] for v in ventas for it in v['items']})
+        existentes = {
+            r['id'] for r in conn.execute(
+                "SELECT id FROM productos WHERE id = ANY(?)", (pids,)
+            ).fetchall()
+        }
+        validas = []
+        for v in ventas:
+            faltan = sorted({it['producto_id'] for it in v['items']} - existentes)
+            if faltan:
+                resultado['rechazadas'].append({'clave': v['clave'], 'faltan': faltan})
+            else:
+                validas.append(v)
+        if not validas:
+            return resultado
+
+        reservar = _reservar_folios_texto if folios_texto else _reservar_folios
+        nuevas, originales = reservar(conn, validas)
+        tipo_id = "text" if folios_texto else "bigint"
+
+        a_insertar = [v for v in validas if v['clave'] in nuevas]
+        if a_insertar:
+            conn.execute(
+                f"""
+                INSERT INTO ventas (id, momento, fecha, total, redondeo, extra_jsonb, clave)
+                SELECT * FROM unnest(?::{tipo_id}[], ?::timestamptz[], ?::text[], ?::numeric[],
+                                     ?::numeric[], ?::jsonb[], ?::text[])
+                """,
+                (
+                    [nuevas[v['clave']] for v in a_insertar],
+                    [v['momento'] for v in a_insertar],
+                    [v['fecha'] for v in a_insertar],
+                    [v['total'] for v in a_insertar],
+                    [v['redondeo'] for v in a_insertar],
+                    [v['extra'] for v in a_insertar],
+                    [v['clave'] for v in a_insertar],
+                ),
+            )
+
+        venta_ids, momentos, prod_ids, cantidades, precios = [], [], [], [], []
+        for v in validas:
+            if v['clave'] not in nuevas:
+                resultado['duplicadas'].append({'clave': v['clave'], 'id': originales.get(v['clave'])})
+                continue
+            vid = nuevas[v['clave']]
+            resultado['insertadas'].append({'clave': v['clave'], 'id': vid})
+            for it in v['items']:
+                venta_ids.append(vid)
+                momentos.append(v['momento'])
+                prod_ids.append(it['producto_id'])
+                cantidades.append(it['cantidad'])
+                precios.append(it['precio_unitario'])
+
+        if venta_ids:
+            conn.execute(
+                f"""
+                INSERT INTO venta_items (venta_id, venta_momento, producto_id, cantidad, precio_unitario)
+                SELECT * FROM unnest(?::{tipo_id}[], ?::timestamptz[], ?::text[], ?::integer[], ?::numeric[])
+                """,
+                (venta_ids, momentos, prod_ids, cantidades, precios),
+            )
+            inventario_registrar(
+                conn, prod_ids, [-c for c in cantidades], "venta", [str(i) for i in venta_ids]
+            )
+    return resultado
+
+_EXPORT_SQL = {
+    "ventas": """
+        SELECT v.id, to_char(v.momento AT TIME ZONE %(tz)s, 'YYYY-MM-DD') AS fecha,
+               to_char(v.momento AT TIME ZONE %(tz)s, 'HH24:MI') AS hora,
+               v.total, COALESCE(v.redondeo, 0) AS redondeo
+        FROM ventas v
+        WHERE {filtro}
+        ORDER BY v.momento, v.id
+    """,
+    "items": """
+        SELECT vi.venta_id, to_char(vi.venta_momento AT TIME ZONE %(tz)s, 'YYYY-MM-DD HH24:MI') AS fecha,
+               vi.producto_id, COALESCE(p.nombre, vi.producto_id) AS nombre,
+               vi.cantidad, vi.precio_unitario, vi.cantidad * vi.precio_unitario AS importe
+        FROM venta_items vi LEFT JOIN productos p ON p.id = vi.producto_id
+        WHERE {filtro}
+        ORDER BY vi.venta_momento, vi.id
+    """,
+}
+
+def ventas_exportar_csv(nivel: str, tz: str, desde=None, hasta=None) -> Iterator[bytes]:
+    """
+    Genera el CSV de ventas (encabezados) o de renglones directo de Postgres con
+    COPY ... TO STDOUT: los bloques pasan tal cual, sin armar filas en Python.
+    """
+    if nivel not in _EXPORT_SQL:
+        raise ValueError("nivel debe ser 'ventas' o 'items'")
+    col = "v.momento" if nivel == "ventas" else "vi.venta_momento"
+    conds = ["TRUE"]
+    params = {"tz": tz, "desde": desde, "hasta": hasta}
+    if desde:
+        conds.append(f"{col} >= %(desde)s")
+    if hasta:
+        conds.append(f"{col} < %(hasta)s")
+    sql = _EXPORT_SQL[nivel].format(filtro=" AND ".join(conds))
+
+    # Reporte pesado: a la réplica si hay
+    with get_db(solo_lectura=True) as conn:
+        # Cursor crudo de psycopg: aquí los placeholders son %(...)s, no ?
+        with conn.cursor() as cur:
+            with cur.copy(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER true)", params) as copy:
+                for bloque in copy:
+                    yield bytes(bloque)
+
+def ventas_respaldar_momentos(tz: ZoneInfo, limite: int = 2000) -> int:
+    """
+    Rellena ventas.momento (a partir del texto de fecha) y después
+    venta_items.venta_momento en ventas heredadas, un lote por llamada, sin
+    depender de la migración a particiones. Regresa cuántas filas tocó (0 = terminado).
+    """
+    with get_db() as conn:
+        # Sin parámetros: la expresión de momento_sql lleva "(?:" y no debe tocarse el "?"
+        n = conn.execute(
+            f"""
+            UPDATE ventas SET momento = {momento_sql('fecha', tz)}
+            WHERE id IN (
+                SELECT id FROM ventas WHERE momento IS NULL
+                LIMIT {int(limite)}
+                FOR UPDATE SKIP LOCKED
+            ) AND momento IS NULL
+            """
+        ).rowcount
+        if n:
+            return n
+        return conn.execute(
+            """
+            UPDATE venta_items vi SET venta_momento = v.momento
+            FROM ventas v
+            WHERE v.id = vi.venta_id AND v.momento IS NOT NULL
+              AND vi.id IN (
+                SELECT id FROM venta_items WHERE venta_momento IS NULL
+                LIMIT ?
+                FOR UPDATE SKIP LOCKED
+              )
+            """,
+            (limite,),
+        ).rowcount
+
+def ventas_respaldar_tipadas(limite: int = 2000) -> int:
+    """
+    Convierte un lote de ventas viejas: extra (texto JSON) -> redondeo numérico
+    y extra_jsonb. Lotes cortos con SKIP LOCKED para no frenar las cajas.
+    Regresa cuántas filas convirtió (0 = terminado).
+    """
+    with get_db() as conn:
+        cur = conn.execute(
+            """
+            UPDATE ventas v SET
+                extra_jsonb = COALESCE(v.extra_jsonb, json_o_vacio(v.extra)),
+                redondeo = COALESCE(numero_o_nulo(json_o_vacio(v.extra)->>'redondeo'), 0)
+            FROM (
+                SELECT id, momento FROM ventas
+                WHERE redondeo IS NULL
+                LIMIT ?
+                FOR UPDATE SKIP LOCKED
+            ) t
+            WHERE v.id = t.id AND v.momento IS NOT DISTINCT FROM t.momento
+            """,
+            (limite,),
+        )
+        return cur.rowcount
+
+
+# -------- Inventario (movimientos append-only) --------
+
+def inventario_registrar(conn, producto_ids: List[str], deltas: List[int],
+                         tipo: str, referencias: Optional[List[str]] = None) -> None:
+    """
+    Anota movimientos de inventario (tipo = venta | reabasto | ajuste).
+    Solo inserta: nunca bloquea la fila del producto, así que varias cajas
+    vendiendo el mismo artículo no se esperan entre sí.
+    """
+    if not producto_ids:
         return
+    conn.execute(
+        """
+        INSERT INTO inventario_movimientos (producto_id, delta, referencia, tipo)
+        SELECT d.producto_id, d.delta, d.referencia, ?
+        FROM unnest(?::text[], ?::integer[], ?::text[]) AS d(producto_id, delta, referencia)
+        """,
+        (tipo, producto_ids, deltas, referencias or [None] * len(producto_ids)),
+    )
+
+def inventario_stock(conn, pid: str) -> int:
+    """Stock según el libro, sin acotar (puede ser negativo): base para calcular ajustes."""
+    row = conn.execute(
+        "SELECT p.stock + COALESCE(m.delta, 0) AS stock "
+        "FROM productos p" + _MOV_PENDIENTES + "WHERE p.id = ?",
+        (pid,),
+    ).fetchone()
+    return int(row["stock"]) if row else 0
+
+def inventario_compactar(limite: int = 5000) -> int:
+    """
+    Consolida hasta `limite` movimientos pendientes en productos.stock y los
+    borra del libro (suma exacta, sin acotar: foto + pendientes no cambia).
+    Las ventas consolidadas se suman de paso a producto_velocidad, fuera del
+    cobro. Varios workers pueden correrlo a la vez (SKIP LOCKED). Regresa
+    cuántos movimientos se consolidaron.
+    """
+    with get_db() as conn:
+        # El stock vigente no cambia al compactar: sin avisos a los paneles
+        conn.execute("SET LOCAL pos.sin_avisos = 'on'")
+        row = conn.execute(
+            f"""
+            WITH mov AS (
+                DELETE FROM inventario_movimientos
+                WHERE id IN (
+                    SELECT id FROM inventario_movimientos
+                    ORDER BY id
+                    LIMIT ?
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING producto_id, tipo, delta, creado_en
+            ), d AS (
+                SELECT producto_id, SUM(delta) AS delta FROM mov GROUP BY producto_id
+            ), upd AS (
+                UPDATE productos p SET stock = p.stock + d.delta
+                FROM d WHERE p.id = d.producto_id
+            ), vendido AS (
+                SELECT producto_id, -delta AS cantidad, creado_en AS momento
+                FROM mov WHERE tipo = 'venta' AND delta < 0
+            ), ultimo AS (
+                SELECT producto_id, max(momento) AS momento FROM vendido GROUP BY producto_id
+            ), vel AS (
+                -- Unidades/día con decaimiento exponencial: O(movimientos), nunca relee el historial
+                INSERT INTO producto_velocidad (producto_id, velocidad, actualizado)
+                SELECT s.producto_id,
+                       sum(s.cantidad * {_decae('u.momento', 's.momento')}) * 86400 / {_TAU_SEG},
+                       u.momento
+                FROM vendido s JOIN ultimo u USING (producto_id)
+                GROUP BY s.producto_id, u.momento
+                ON CONFLICT (producto_id) DO UPDATE SET
+                    velocidad = producto_velocidad.velocidad
+                                  * {_decae('excluded.actualizado', 'producto_velocidad.actualizado')}
+                              + excluded.velocidad
+                                  * {_decae('producto_velocidad.actualizado', 'excluded.actualizado')},
+                    actualizado = GREATEST(producto_velocidad.actualizado, excluded.actualizado)
+            )
+            SELECT COUNT(*) AS n FROM mov
+            """,
+            (limite,),
+        ).fetchone()
+    return int(row["n"] or 0)
+
+
+# -------- Reabasto --------
+
+# Vida media de la velocidad de venta, en días: lo vendido hace VIDA_MEDIA
+# días pesa la mitad que lo vendido hoy.
+VIDA_MEDIA_DIAS = 14.0
+_TAU_SEG = VIDA_MEDIA_DIAS * 86400 / math.log(2)
+
+# Decaimiento exponencial entre dos instantes (acotado para evitar underflow)
+def _decae(hasta: str, desde: str) -> str:
+    return f"exp(-LEAST(700, GREATEST(0, extract(epoch FROM {hasta} - {desde})) / {_TAU_SEG}))"
+
+def velocidad_reconstruir(dias: int = 90) -> int:
+    """
+    Siembra producto_velocidad con las ventas de los últimos `dias` (instalaciones
+    que ya tenían historial). Regresa cuántos productos quedaron con velocidad.
+    """
     with get_db() as conn:
-        # Limpia items que referencian al producto (por si tu FK no está en cascada)
-        conn.execute("DELETE FROM venta_items WHERE producto_id = ?", (pid,))
-        conn.execute("DELETE FROM productos WHERE id = ?", (pid,))
+        conn.execute("DELETE FROM producto_velocidad")
+        conn.execute(
+            f"""
+            INSERT INTO producto_velocidad (producto_id, velocidad, actualizado)
+            SELECT vi.producto_id,
+                   sum(vi.cantidad * {_decae('now()', 'vi.venta_momento')}) * 86400 / {_TAU_SEG},
+                   now()
+            FROM venta_items vi JOIN productos p ON p.id = vi.producto_id
+            WHERE vi.venta_momento >= now() - make_interval(days => ?)
+            GROUP BY vi.producto_id
+            """,
+            (dias,),
+        )
+        return conn.execute("SELECT count(*) AS n FROM producto_velocidad").fetchone()["n"]
 
+def reabasto_sugerido(proveedor_id: Optional[str] = None, dias_cobertura: int = 14,
+                      limite: int = 500) -> List[Dict]:
+    """
+    Productos a pedir, del que se acaba primero al último. Parte de
+    producto_velocidad (solo lo que se vende), no de todo el catálogo.
+    sugerido = lo necesario para cubrir `dias_cobertura` días de venta.
+    """
+    filtro, params = "", []
+    if proveedor_id is not None:
+        filtro = "AND COALESCE(p.proveedor_id, '') = ?"
+        params.append(proveedor_id)
+
+    with get_db() as conn:
+        rows = conn.execute(
+            f"""
+            SELECT * FROM (
+                SELECT p.id, p.nombre, p.categoria, p.proveedor_id,
+                       COALESCE(pr.nombre, '') AS proveedor,
+                       GREATEST(0, p.stock + COALESCE(m.delta, 0)) AS stock,
+                       v.velocidad * {_decae('now()', 'v.actualizado')} AS velocidad
+                FROM producto_velocidad v
+                JOIN productos p ON p.id = v.producto_id
+                LEFT JOIN proveedores pr ON pr.id = p.proveedor_id
+                {_MOV_PENDIENTES}
+                WHERE p.activo AND v.velocidad > 0 {filtro}
+            ) t
+            CROSS JOIN LATERAL (
+                SELECT t.stock / NULLIF(t.velocidad, 0) AS dias_restantes,
+                       ceil(t.velocidad * ? - t.stock)::integer AS sugerido
+            ) c
+            -- Menos de una pieza cada 100 días ya no cuenta como rotación
+            WHERE c.sugerido > 0 AND t.velocidad >= 0.01
+            ORDER BY c.dias_restantes, t.velocidad DESC
+            LIMIT ?
+            """,
+            params + [dias_cobertura, limite],
+        ).fetchall()
+    return [
+        {
+            "id": r["id"],
+            "nombre": r["nombre"],
+            "categoria": r["categoria"] or "",
+            "proveedor_id": r["proveedor_id"] or "",
+            "proveedor": r["proveedor"],
+            "stock": int(r["stock"]),
+            "velocidad": round(float(r["velocidad"]), 3),
+            "dias_restantes": round(float(r["dias_restantes"]), 1),
+            "sugerido": int(r["sugerido"]),
+        }
+        for r in rows
+    ]
 
 # -------- Proveedores --------
 